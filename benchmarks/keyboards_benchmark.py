@@ -0,0 +1,75 @@
+"""
+Compare building reply markups per message with the pre-serialized registry in keyboards.py.
+
+Each round does what the send path does with a reply markup: get it and call
+to_json() on it. Reports time per round and bytes allocated per round (tracemalloc).
+
+Usage:
+    python3 benchmarks/keyboards_benchmark.py
+"""
+
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import keyboards
+
+ROUNDS = 20000
+USER_IDS = [str(user_id) for user_id in range(100)]
+
+
+def send_path_rebuilt(round_index: int) -> None:
+    keyboards._build_cancel_keyboard().to_json()
+    keyboards._build_affirmation_keyboard().to_json()
+    keyboards._build_request_chat_keyboard().to_json()
+    keyboards._build_request_users_keyboard().to_json()
+    keyboards._build_private_message_keyboard(USER_IDS[round_index % len(USER_IDS)]).to_json()
+
+
+def send_path_registry(round_index: int) -> None:
+    keyboards.create_cancel_keyboard().to_json()
+    keyboards.create_affirmation_keyboard().to_json()
+    keyboards.create_request_chat_keyboard().to_json()
+    keyboards.create_request_users_keyboard().to_json()
+    keyboards.create_private_message_keyboard(USER_IDS[round_index % len(USER_IDS)]).to_json()
+
+
+def measure(send_path) -> dict:
+    # Warm up caches so only the steady state is measured.
+    for round_index in range(len(USER_IDS)):
+        send_path(round_index)
+
+    counter = iter(range(ROUNDS))
+    seconds = timeit.timeit(lambda: send_path(next(counter)), number=ROUNDS)
+
+    tracemalloc.start()
+    allocated = 0
+    for round_index in range(1000):
+        snapshot_before = tracemalloc.get_traced_memory()[0]
+        send_path(round_index)
+        allocated += max(tracemalloc.get_traced_memory()[1] - snapshot_before, 0)
+        tracemalloc.reset_peak()
+    tracemalloc.stop()
+
+    return {
+        "microseconds_per_round": seconds / ROUNDS * 1e6,
+        "peak_bytes_per_round": allocated / 1000,
+    }
+
+
+if __name__ == "__main__":
+    rebuilt = measure(send_path_rebuilt)
+    registry = measure(send_path_registry)
+
+    print(f"{'':10} {'us/round':>10} {'peak bytes/round':>18}")
+    for name, result in (("rebuilt", rebuilt), ("registry", registry)):
+        print(f"{name:10} {result['microseconds_per_round']:10.2f} {result['peak_bytes_per_round']:18.0f}")
+    print(
+        "speedup: {0:.1f}x, allocation savings: {1:.0f} bytes/round".format(
+            rebuilt["microseconds_per_round"] / registry["microseconds_per_round"],
+            rebuilt["peak_bytes_per_round"] - registry["peak_bytes_per_round"]
+        )
+    )
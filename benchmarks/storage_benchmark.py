@@ -0,0 +1,50 @@
+"""
+Measure RedisDatabase operations on a storage backend.
+
+Uses the in-process MemoryBackend unless STORAGE_BACKEND=redis is set.
+
+Usage:
+    python3 benchmarks/storage_benchmark.py
+    STORAGE_BACKEND=redis python3 benchmarks/storage_benchmark.py
+"""
+
+import os
+import sys
+import time
+import asyncio
+
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from redis_database import RedisDatabase as rd
+
+ROUNDS = 20000
+SHORT_MESSAGE = "See you at 8."
+LONG_MESSAGE = "A long private message that is compressed before it's stored. " * 40
+
+
+async def measure(name: str, operation) -> None:
+    started = time.perf_counter()
+    for round_index in range(ROUNDS):
+        await operation(round_index)
+    elapsed = time.perf_counter() - started
+    print(f"{name:32} {elapsed / ROUNDS * 1e6:10.2f} us/op")
+
+
+async def main() -> None:
+    print(f"backend: {os.environ['STORAGE_BACKEND']}")
+    await rd.add_chat_id(-100)
+
+    await measure("check_chat_id", lambda i: rd.check_chat_id(-100))
+    await measure("store_private_message (short)",
+        lambda i: rd.store_private_message("1", "-100", str(i), SHORT_MESSAGE))
+    await measure("get_private_message (short)",
+        lambda i: rd.get_private_message("1", "-100", str(i)))
+    await measure("store_private_message (long)",
+        lambda i: rd.store_private_message("2", "-100", str(i), LONG_MESSAGE))
+    await measure("get_private_message (long)",
+        lambda i: rd.get_private_message("2", "-100", str(i)))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,158 @@
+"""
+Circuit breakers around redis and the SQL database.
+
+A breaker counts failed and slow calls. Only errors of the backend itself
+(`failure_exceptions`: lost connections, timeouts, a locked database) are
+failures; other errors, like a missing row, mean the backend answered and count
+like any finished call. After `failure_threshold` failed or slow calls in a
+row it opens and every call fails immediately with CircuitOpenError instead of
+waiting for a stalled backend. After `reset_timeout` seconds it lets one probe
+call through (half-open): a fast success closes it again, anything else opens
+it for another `reset_timeout`.
+
+Async calls are also cut off after `call_timeout` seconds. Synchronous calls
+(the sqlite queries) can't be interrupted, so only their duration counts.
+"""
+
+import time
+import asyncio
+import functools
+from typing import Optional, Tuple, Type
+
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from sqlalchemy.exc import InterfaceError, InternalError, OperationalError, TimeoutError as PoolTimeoutError
+from telebot.async_telebot import logger
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend whose circuit is open."""
+
+    def __init__(self, name: str):
+        super().__init__(f"The circuit of {name} is open.")
+        self.name = name
+
+
+class CircuitBreaker():
+    def __init__(self, name: str, failure_exceptions: Tuple[Type[BaseException], ...],
+            failure_threshold: int = 5, reset_timeout: float = 10,
+            call_timeout: Optional[float] = 1.0, slow_call_duration: float = 0.5):
+        self.name = name
+        # TimeoutError is raised when call_timeout is exceeded.
+        self.failure_exceptions = failure_exceptions + (TimeoutError,)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.call_timeout = call_timeout
+        self.slow_call_duration = slow_call_duration
+
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def is_closed(self) -> bool:
+        return self.state == CLOSED
+
+    @property
+    def is_open(self) -> bool:
+        """True while calls fail fast, False once a probe call is due."""
+        return self.state == OPEN and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def _before_call(self) -> bool:
+        """Raise CircuitOpenError if the call isn't allowed, return whether it's the probe."""
+        if self.state == CLOSED:
+            return False
+        if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        raise CircuitOpenError(self.name)
+
+    def _open(self) -> None:
+        if self.state != OPEN:
+            logger.warning(f"Circuit of {self.name} opened.")
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+
+    def _after_call(self, is_probe: bool, duration: float, failed: bool) -> None:
+        if is_probe:
+            self._probing = False
+        if failed or duration > self.slow_call_duration:
+            self._failures += 1
+            if is_probe or self._failures >= self.failure_threshold:
+                self._open()
+            return
+
+        if self.state != CLOSED:
+            logger.info(f"Circuit of {self.name} closed.")
+        self.state = CLOSED
+        self._failures = 0
+
+    async def call(self, function, *args, **kwargs):
+        is_probe = self._before_call()
+        started = time.monotonic()
+        try:
+            async with asyncio.timeout(self.call_timeout):
+                result = await function(*args, **kwargs)
+        except self.failure_exceptions:
+            self._after_call(is_probe, time.monotonic() - started, failed=True)
+            raise
+        except asyncio.CancelledError:
+            # The caller gave up, it says nothing about the backend.
+            if is_probe:
+                self._probing = False
+            raise
+        except Exception:
+            self._after_call(is_probe, time.monotonic() - started, failed=False)
+            raise
+        self._after_call(is_probe, time.monotonic() - started, failed=False)
+        return result
+
+    def call_sync(self, function, *args, **kwargs):
+        is_probe = self._before_call()
+        started = time.monotonic()
+        try:
+            result = function(*args, **kwargs)
+        except self.failure_exceptions:
+            self._after_call(is_probe, time.monotonic() - started, failed=True)
+            raise
+        except BaseException:
+            self._after_call(is_probe, time.monotonic() - started, failed=False)
+            raise
+        self._after_call(is_probe, time.monotonic() - started, failed=False)
+        return result
+
+    def protect(self, function):
+        """Decorator running a coroutine function through the breaker."""
+        @functools.wraps(function)
+        async def protected(*args, **kwargs):
+            return await self.call(function, *args, **kwargs)
+        return protected
+
+    def protect_sync(self, function):
+        """Decorator running a function through the breaker."""
+        @functools.wraps(function)
+        def protected(*args, **kwargs):
+            return self.call_sync(function, *args, **kwargs)
+        return protected
+
+
+redis_breaker = CircuitBreaker(
+    "redis", (RedisConnectionError, RedisTimeoutError),
+    call_timeout=1.0, slow_call_duration=0.25
+)
+# IntegrityError and ProgrammingError are left out, they're errors of the query, not of sqlite.
+sql_breaker = CircuitBreaker(
+    "sql", (OperationalError, InterfaceError, InternalError, PoolTimeoutError),
+    call_timeout=None, slow_call_duration=0.25
+)
+
+
+def is_degraded() -> bool:
+    """Return True if any backend isn't fully available."""
+    return not (redis_breaker.is_closed and sql_breaker.is_closed)
@@ -0,0 +1,173 @@
+"""
+Background refresh of the groups table.
+
+recieve_group_info stores a group's title, username, description, bio and photo
+once, when the bot joins. GroupMetadataRefresher goes through the table again
+every GROUP_REFRESH_INTERVAL seconds and writes what changed since, so links
+built from the username keep working after a group is renamed or goes private.
+
+The refresh never blocks update handling:
+    - groups are read a page at a time by chat_id (keyset pagination) and
+      every database call runs in a thread
+    - get_chat is called within the refresher's own request budget
+    - only changed columns are written, one transaction per page
+    - it pauses while redis or the database is unhealthy (circuit_breaker.py)
+
+Progress is kept in redis (RedisDatabase.get_group_refresh_progress): the last
+chat_id of every written page and when the last refresh finished. A restarted
+process continues an unfinished refresh where it stopped and otherwise waits
+until the next one is due.
+
+Each process runs one refresher for all of its bots. A group is read with the
+first bot registered in it (RedisDatabase.check_chat_id in that bot's
+namespace), so the same bot always reads it and groups nobody is in are skipped.
+
+Nothing caches group metadata in memory, handlers read it from the table, so
+there is nothing else to invalidate after a page is written.
+"""
+
+import os
+import json
+import time
+import asyncio
+from typing import Dict, List, Optional
+
+from telebot.async_telebot import AsyncTeleBot, logger
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.types import ChatFullInfo
+
+import rate_limit
+import sql_database
+from circuit_breaker import is_degraded
+from redis_database import RedisDatabase as rd, key_namespace
+
+GROUP_REFRESH_INTERVAL = int(os.environ.get("GROUP_REFRESH_INTERVAL", 86400)) # 0 disables the refresh.
+REFRESH_REQUESTS_PER_SECOND = 5 # Leaves most of the bot's request budget to the handlers.
+REFRESH_PAGE_SIZE = 100 # Number of groups read and written at once.
+DEGRADED_PAUSE_SECONDS = 10
+DEFAULT_RETRY_AFTER = 5
+FAILED_REFRESH_RETRY_SECONDS = 60
+
+
+def get_chat_metadata(group_info: ChatFullInfo) -> Dict[str, Optional[str]]:
+    """Return the refreshed columns of the groups table, as recieve_group_info stores them."""
+    return {
+        "title": group_info.title,
+        "username": group_info.username,
+        "description": group_info.description,
+        "bio": group_info.bio,
+        "json_photos": json.dumps(group_info.photo.__dict__) if group_info.photo is not None else None,
+    }
+
+
+class GroupMetadataRefresher():
+    def __init__(self, bots: Dict[str, AsyncTeleBot], rate: float = REFRESH_REQUESTS_PER_SECOND,
+            page_size: int = REFRESH_PAGE_SIZE):
+        """`bots` maps key namespaces to bots, {"": bot} for a single bot."""
+        self.bots = bots
+        self.bucket = rate_limit.TokenBucket(rate, capacity=1)
+        self.page_size = page_size
+
+    async def _get_registered_bots(self, chat_ids: List[int]) -> List[Optional[AsyncTeleBot]]:
+        """Return the first bot registered in each group, None for groups without one."""
+        registered_bots = [None] * len(chat_ids)
+        for namespace, bot in self.bots.items():
+            token = key_namespace.set(namespace)
+            try:
+                registered = await rd.check_chat_ids(chat_ids)
+            finally:
+                key_namespace.reset(token)
+            for index, is_registered in enumerate(registered):
+                if is_registered and registered_bots[index] is None:
+                    registered_bots[index] = bot
+        return registered_bots
+
+    async def _get_chat_metadata(self, bot: AsyncTeleBot, chat_id: int) -> Optional[Dict[str, Optional[str]]]:
+        """Return the current metadata of a group, None if it can't be read."""
+        while True:
+            await self.bucket.acquire()
+            try:
+                return get_chat_metadata(await bot.get_chat(chat_id))
+            except ApiTelegramException as ex:
+                if ex.error_code == 429:
+                    parameters = (ex.result_json or {}).get("parameters") or {}
+                    await asyncio.sleep(parameters.get("retry_after", DEFAULT_RETRY_AFTER))
+                    continue
+                # The bot left the group, was removed or the group was deleted.
+                return None
+            except Exception as ex:
+                logger.warning(f"Couldn't refresh group {chat_id}: {ex}")
+                return None
+
+    async def refresh_all(self, after_chat_id: Optional[int] = None) -> Dict[str, int]:
+        """Refresh every group after `after_chat_id` (all if it's None) and record the progress.
+
+        Returns the number of checked, changed, failed and skipped (no bot registered) groups.
+        """
+        checked = changed = failed = skipped = 0
+        while True:
+            while is_degraded():
+                await asyncio.sleep(DEGRADED_PAUSE_SECONDS)
+
+            rows = await asyncio.to_thread(
+                sql_database.get_group_metadata_page, after_chat_id, self.page_size
+            )
+            if not rows:
+                break
+
+            changes = {}
+            bots = await self._get_registered_bots([row["chat_id"] for row in rows])
+            for row, bot in zip(rows, bots):
+                if bot is None:
+                    skipped += 1
+                    continue
+                metadata = await self._get_chat_metadata(bot, row["chat_id"])
+                checked += 1
+                if metadata is None:
+                    failed += 1
+                    continue
+                columns = {column: value for column, value in metadata.items() if row[column] != value}
+                if columns:
+                    changes[row["chat_id"]] = columns
+
+            await asyncio.to_thread(sql_database.update_group_metadata, changes)
+            changed += len(changes)
+            after_chat_id = rows[-1]["chat_id"]
+            await rd.set_group_refresh_cursor(after_chat_id)
+
+        await rd.finish_group_refresh()
+        return {"checked": checked, "changed": changed, "failed": failed, "skipped": skipped}
+
+    async def run_forever(self, interval: float = GROUP_REFRESH_INTERVAL) -> None:
+        while True:
+            try:
+                cursor, finished_at = await rd.get_group_refresh_progress()
+                if cursor is None and finished_at is not None:
+                    wait = finished_at + interval - time.time()
+                    if wait > 0:
+                        # The progress is read again afterwards, another process may have refreshed.
+                        await asyncio.sleep(wait)
+                        continue
+
+                started = time.monotonic()
+                result = await self.refresh_all(after_chat_id=cursor)
+                logger.info(
+                    "Group metadata refreshed in {0:.0f}s: {1[checked]} checked, {1[changed]} changed, "
+                    "{1[failed]} failed, {1[skipped]} skipped.".format(time.monotonic() - started, result)
+                )
+            except Exception as ex:
+                logger.error(f"Group metadata refresh failed: {ex}", exc_info=True)
+                await asyncio.sleep(FAILED_REFRESH_RETRY_SECONDS)
+
+
+def start_group_refresher(bots: Dict[str, AsyncTeleBot]) -> Optional[asyncio.Task]:
+    """Start refreshing the groups table in the background, None if GROUP_REFRESH_INTERVAL is 0.
+
+    Start it once per process, `bots` maps key namespaces to bots ({"": bot} for one bot).
+    The caller has to keep a reference to the returned task.
+    """
+    if GROUP_REFRESH_INTERVAL <= 0:
+        return None
+    return asyncio.create_task(
+        GroupMetadataRefresher(bots).run_forever(GROUP_REFRESH_INTERVAL), name="group-refresher"
+    )
@@ -1,9 +1,40 @@
+"""
+Reply markups of the bot.
+
+Telegram only receives reply markups as JSON, so every markup is wrapped in a
+PreSerializedMarkup which serializes it once. Static markups are built at import
+and the create_* functions return the same object on every call. The private
+message keyboard only depends on the recipient, so it's cached in a bounded LRU.
+"""
+
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
 from telebot.types import (ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
         KeyboardButtonRequestUsers, KeyboardButtonRequestChat,
-        InlineKeyboardButton, InlineKeyboardMarkup)
+        InlineKeyboardButton, InlineKeyboardMarkup, JsonSerializable)
+
+PRIVATE_MESSAGE_KEYBOARD_CACHE_SIZE = 4096
+INBOX_KEYBOARD_CACHE_SIZE = 256
+SUPERGROUP_ID_PREFIX = "-100" # Bot API ids of supergroups are their internal id prefixed with -100.
+
 
+class PreSerializedMarkup(JsonSerializable):
+    """A reply markup whose JSON is built once.
 
-def create_request_chat_keyboard() -> ReplyKeyboardMarkup:
+    telebot converts a reply_markup with to_json() before every request,
+    this returns the JSON which was built at creation.
+    """
+
+    def __init__(self, markup: JsonSerializable):
+        self.markup = markup
+        self._json = markup.to_json()
+
+    def to_json(self) -> str:
+        return self._json
+
+
+def _build_request_chat_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         resize_keyboard=True,
         row_width=1
@@ -22,7 +53,7 @@ def create_request_chat_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
-def create_request_users_keyboard() -> ReplyKeyboardMarkup:
+def _build_request_users_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         resize_keyboard=True,
         row_width=1
@@ -40,7 +71,7 @@ def create_request_users_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
-def create_affirmation_keyboard() -> InlineKeyboardMarkup:
+def _build_affirmation_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup().add(
         InlineKeyboardButton(
             text="Yes!",
@@ -53,25 +84,74 @@ def create_affirmation_keyboard() -> InlineKeyboardMarkup:
     )
 
 
-def create_private_message_keyboard(user_id: str) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup().add(
+def _build_private_message_keyboard(user_id: str, full_message_url: str = None) -> InlineKeyboardMarkup:
+    keyboard = InlineKeyboardMarkup().add(
         InlineKeyboardButton(
             text="Show the message.",
             callback_data=f"private_message:{user_id}"
         )
     )
+    if full_message_url is not None:
+        keyboard.add(
+            InlineKeyboardButton(
+                text="Read the full message.",
+                url=full_message_url
+            )
+        )
+    return keyboard
+
+
+def get_message_url(group_chat_id: int, group_username: Optional[str], message_id: int) -> Optional[str]:
+    """Return the link of a group message, None if the group has none.
+
+    Public groups are linked by username. Private supergroups (no username, for
+    example after the group went private) have t.me/c/ links, which work for their
+    members. Basic groups have no message links.
+    """
+    if group_username:
+        return f"https://t.me/{group_username}/{message_id}"
+    group_chat_id = str(group_chat_id)
+    if group_chat_id.startswith(SUPERGROUP_ID_PREFIX):
+        return f"https://t.me/c/{group_chat_id[len(SUPERGROUP_ID_PREFIX):]}/{message_id}"
+    return None
 
 
-def create_linked_message_keyboard(group_username: str, message_id: str) -> InlineKeyboardMarkup:
+def _build_linked_message_keyboard(message_url: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup().add(
         InlineKeyboardButton(
             text="Show the sent message.",
-            url=f"https://t.me/{group_username}/{message_id}"
+            url=message_url
         )
     )
 
 
-def create_cancel_keyboard() -> ReplyKeyboardMarkup:
+def _build_inbox_keyboard(page: int, pages: int) -> InlineKeyboardMarkup:
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="Previous", callback_data=f"inbox:page:{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton(text="Next", callback_data=f"inbox:page:{page + 1}"))
+    return InlineKeyboardMarkup().add(*buttons)
+
+
+def create_group_selection_keyboard(groups: List[Tuple[int, str]], page: int, pages: int) -> InlineKeyboardMarkup:
+    # Titles change and lists differ per user, so it isn't cached.
+    keyboard = InlineKeyboardMarkup(row_width=1).add(*(
+        InlineKeyboardButton(text=title, callback_data=f"pick_group:{chat_id}")
+        for chat_id, title in groups
+    ))
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="Previous", callback_data=f"pick_group_page:{page - 1}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton(text="Next", callback_data=f"pick_group_page:{page + 1}"))
+    if navigation:
+        keyboard.row(*navigation)
+    keyboard.row(InlineKeyboardButton(text="Choose another group.", callback_data="pick_group:other"))
+    return keyboard
+
+
+def _build_cancel_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(resize_keyboard=True).add(
         KeyboardButton(
             text="Cancel"
@@ -79,5 +159,55 @@ def create_cancel_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
-def remove_keyboard():
-    return ReplyKeyboardRemove()
+_REQUEST_CHAT_KEYBOARD = PreSerializedMarkup(_build_request_chat_keyboard())
+_REQUEST_USERS_KEYBOARD = PreSerializedMarkup(_build_request_users_keyboard())
+_AFFIRMATION_KEYBOARD = PreSerializedMarkup(_build_affirmation_keyboard())
+_CANCEL_KEYBOARD = PreSerializedMarkup(_build_cancel_keyboard())
+_REMOVE_KEYBOARD = PreSerializedMarkup(ReplyKeyboardRemove())
+
+
+def create_request_chat_keyboard() -> PreSerializedMarkup:
+    return _REQUEST_CHAT_KEYBOARD
+
+
+def create_request_users_keyboard() -> PreSerializedMarkup:
+    return _REQUEST_USERS_KEYBOARD
+
+
+def create_affirmation_keyboard() -> PreSerializedMarkup:
+    return _AFFIRMATION_KEYBOARD
+
+
+@lru_cache(maxsize=PRIVATE_MESSAGE_KEYBOARD_CACHE_SIZE)
+def _cached_private_message_keyboard(user_id: str) -> PreSerializedMarkup:
+    return PreSerializedMarkup(_build_private_message_keyboard(user_id))
+
+
+def create_private_message_keyboard(user_id: str, full_message_url: str = None) -> JsonSerializable:
+    # Deep links are unique per message, caching them would only evict useful entries.
+    if full_message_url is not None:
+        return _build_private_message_keyboard(user_id, full_message_url)
+    return _cached_private_message_keyboard(str(user_id))
+
+
+def create_linked_message_keyboard(group_chat_id: int, group_username: Optional[str],
+        message_id: int) -> Optional[InlineKeyboardMarkup]:
+    """Return the keyboard linking the sent message, None if the group has no message links."""
+    # Unique per message, so it isn't cached.
+    message_url = get_message_url(group_chat_id, group_username, message_id)
+    if message_url is None:
+        return None
+    return _build_linked_message_keyboard(message_url)
+
+
+@lru_cache(maxsize=INBOX_KEYBOARD_CACHE_SIZE)
+def create_inbox_keyboard(page: int, pages: int) -> PreSerializedMarkup:
+    return PreSerializedMarkup(_build_inbox_keyboard(page, pages))
+
+
+def create_cancel_keyboard() -> PreSerializedMarkup:
+    return _CANCEL_KEYBOARD
+
+
+def remove_keyboard() -> PreSerializedMarkup:
+    return _REMOVE_KEYBOARD
@@ -0,0 +1,154 @@
+"""
+Non-blocking logging pipeline for error_logger.
+
+Handlers only put records on a bounded queue; formatting tracebacks and writing
+to the file and the console happen in a QueueListener thread, never on the
+event loop thread. Repeated identical exceptions are logged once per window and
+the number of suppressed duplicates is attached to the next logged one.
+"""
+
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Tuple
+
+QUEUE_SIZE = 10000 # Records beyond this are dropped instead of blocking the caller.
+MAX_LOG_FILE_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUP_COUNT = 5
+DEDUPLICATION_WINDOW = 60 # Seconds an identical exception is suppressed for.
+DEDUPLICATION_MAX_KEYS = 1000 # Least recently seen records beyond this are forgotten.
+
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as a single JSON line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "name": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "module": record.module,
+            "function": record.funcName,
+            "line": record.lineno,
+        }
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed_duplicates"] = suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DuplicateFilter(logging.Filter):
+    """Let an identical record through at most once per `window` seconds.
+
+    Records are identical when they have the same exception type, exception
+    message and raising location, or for records without an exception, the same
+    logger, level and message template.
+
+    At most `max_keys` records are remembered, the least recently seen one is
+    forgotten first, so filtering stays O(1) however many distinct errors occur.
+    """
+
+    def __init__(self, window: float = DEDUPLICATION_WINDOW, max_keys: int = DEDUPLICATION_MAX_KEYS):
+        super().__init__()
+        self.window = window
+        self.max_keys = max_keys
+        # key -> (time the record was let through, number of suppressed duplicates), least recently seen first
+        self._seen: OrderedDict[Tuple, Tuple[float, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(record: logging.LogRecord) -> Tuple:
+        if record.exc_info and record.exc_info[1] is not None:
+            exception = record.exc_info[1]
+            traceback = record.exc_info[2]
+            while traceback is not None and traceback.tb_next is not None:
+                traceback = traceback.tb_next
+            location = (
+                (traceback.tb_frame.f_code.co_filename, traceback.tb_lineno)
+                if traceback is not None else None
+            )
+            return (type(exception).__name__, str(exception), location)
+        return (record.name, record.levelno, str(record.msg))
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = self._get_key(record)
+        now = time.monotonic()
+        with self._lock:
+            last_logged, suppressed = self._seen.get(key, (None, 0))
+            if last_logged is not None and now - last_logged < self.window:
+                self._seen[key] = (last_logged, suppressed + 1)
+                self._seen.move_to_end(key)
+                return False
+
+            self._seen[key] = (now, 0)
+            self._seen.move_to_end(key)
+            if len(self._seen) > self.max_keys:
+                self._seen.popitem(last=False)
+        record.suppressed = suppressed
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler which defers formatting to the listener and drops records when the queue is full."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # QueueHandler.prepare formats the traceback in the calling thread.
+        # The listener's handlers format it instead, so only the message is merged.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _stop_listener(listener: QueueListener) -> None:
+    # QueueListener.stop() fails if the listener was already stopped.
+    if listener._thread is not None:
+        listener.stop()
+
+
+def setup_error_logger(logger: logging.Logger, filename: str) -> QueueListener:
+    """Attach the queued pipeline to `logger` and start its listener thread.
+
+    The file gets JSON lines and is rotated by size, the console keeps the human readable format.
+    The listener is stopped (and the queue flushed) at interpreter exit.
+    """
+    log_queue = queue.Queue(maxsize=QUEUE_SIZE)
+
+    file_handler = RotatingFileHandler(
+        filename,
+        maxBytes=MAX_LOG_FILE_BYTES,
+        backupCount=LOG_FILE_BACKUP_COUNT,
+        encoding="utf-8"
+    )
+    file_handler.setFormatter(JsonFormatter())
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(
+        logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    )
+
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(DuplicateFilter())
+    logger.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(_stop_listener, listener)
+    return listener
@@ -1,59 +1,81 @@
 import os
-import json
+import time
 import asyncio
 import logging
 from datetime import datetime
+from collections import OrderedDict
+
+import startup
+startup_timer = startup.StartupTimer()
 
 import telebot
-from telebot.formatting import munderline, mcite
 from telebot.async_telebot import AsyncTeleBot, ExceptionHandler
-from telebot.types import Message, ChatFullInfo, User, CallbackQuery
+from telebot.types import Message, ChatFullInfo, User, CallbackQuery, ChatMemberUpdated
 from telebot.states import State, StatesGroup
 from telebot.states.asyncio.context import StateContext
-from telebot.asyncio_storage import StateRedisStorage
 from telebot.asyncio_filters import StateFilter, TextStartsFilter, AdvancedCustomFilter
 from telebot.states.asyncio.middleware import StateMiddleware
+from telebot.asyncio_handler_backends import BaseMiddleware, CancelUpdate
+startup_timer.mark("imports: telebot")
 
+# Also imports circuit_breaker, which needs sqlalchemy's and redis' exceptions.
 import sql_database
+startup_timer.mark("imports: sqlalchemy and sql_database")
+
+import storage_backends
+from circuit_breaker import CircuitOpenError, redis_breaker, is_degraded
+from redis_database import RedisDatabase as rd, key_namespace
+startup_timer.mark("imports: storage backends and circuit breakers")
+
 import keyboards
+import group_refresher
+import logging_pipeline
 import messages
-from redis_database import RedisDatabase as rd
+startup_timer.mark("imports: other bot modules")
 
 logger = telebot.async_telebot.logger
 logger.setLevel("INFO")
 
 #error_logger just handles ERROR and CRITICAL 
+#Records are written by a background thread, see logging_pipeline.py
 error_logger = logging.getLogger(__name__)
 error_logger.setLevel(logging.ERROR)
-stream_handler = logging.StreamHandler()
-file_handler = logging.FileHandler('error.log', encoding='utf-8')
-file_handler.setLevel(logging.ERROR)
-stream_handler.setLevel(logging.ERROR)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(formatter)
-stream_handler.setFormatter(formatter)
-error_logger.addHandler(stream_handler)
-error_logger.addHandler(file_handler)
+# The file is rotated by this process alone, supervisor.py gives each worker its own file.
+ERROR_LOG_FILE = os.environ.get("ERROR_LOG_FILE", "error.log")
+error_log_listener = logging_pipeline.setup_error_logger(error_logger, ERROR_LOG_FILE)
 
 # Constants
-# Number of characters for private messsage.
+# Number of characters for private messsage preview.
 # It sends as an answerCallbackQuery which is limited to 200 characters.
+# Longer private messages are delivered in the bot's private chat through a deep link.
 LIMIT_PRIVATE_MESSAGE_CHARS = 200
+LIMIT_TEXT_MESSAGE_CHARS = 4096 # Limit of a single text message sent by the bot.
+FULL_PRIVATE_MESSAGE_PREFIX = "pm_" # Start parameter prefix of full private message deep links.
 LIMIT_DESCRIPTION_CHARS = 1000 # Limit of the description which is sent to a public group or supergroup.
+DEFAULT_PROFILE_SECONDS = 30
+INBOX_PAGE_SIZE = 5 # Number of private messages on one /inbox page.
+LIMIT_INBOX_PREVIEW_CHARS = 500 # Longer private messages are linked instead of shown in /inbox.
+GROUP_SELECTION_PAGE_SIZE = 8 # Number of groups on one page of the group selection list.
+GROUP_SEEN_REFRESH_SECONDS = 3600 # How often a user's "last seen in group" time is written.
+GROUP_SEEN_CACHE_SIZE = 100000 # Number of (user, group) write times remembered in memory.
+UNAVAILABLE_NOTICE_SECONDS = 10 # A chat is told "try again shortly" at most once in this time.
+UNAVAILABLE_NOTICE_CACHE_SIZE = 10000 # Number of chats whose last notice time is remembered.
+# Update types requested from telegram, chat_member is only sent when it's listed explicitly.
+ALLOWED_UPDATES = ["message", "callback_query", "my_chat_member", "chat_member"]
+
+# Comma separated user ids which may use admin commands like /profile.
+ADMIN_USER_IDS = {
+    int(user_id) for user_id in os.environ.get("ADMIN_USER_IDS", "").split(",") if user_id.strip()
+}
 
 class BotExceptionHandler(ExceptionHandler):
     async def handle(self, exception):
+        # Open circuits are logged once by the breaker, not for every shed update.
+        if isinstance(exception, CircuitOpenError):
+            return True
         error_logger.error(exception, exc_info=True)
 
 TOKEN = os.environ.get("BOT_TOKEN", None)
-if not TOKEN:
-    raise ValueError("The token doesn't exist.")
-
-bot = AsyncTeleBot(
-    token=TOKEN,
-    exception_handler=BotExceptionHandler(),
-    state_storage=StateRedisStorage()
-)
 
 class PrivateMessageStates(StatesGroup):
     shared_user = State()
@@ -69,15 +91,137 @@ class CallbackTextStartsFilter(AdvancedCustomFilter):
     async def check(self, callback: CallbackQuery, text: str):
         return callback.data.startswith(text)
 
-bot.add_custom_filter(StateFilter(bot))
-bot.add_custom_filter(TextStartsFilter())
-bot.add_custom_filter(CallbackTextStartsFilter())
+class GroupMembershipMiddleware(BaseMiddleware):
+    """Keep the index of the groups each user was seen in, see RedisDatabase.add_user_group.
+
+    Users are added from group messages and chat_member updates and removed when they
+    leave. A user is written at most once per GROUP_SEEN_REFRESH_SECONDS per group,
+    so busy groups don't cause a redis write for every message.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "chat_member"]
+        self._last_written = OrderedDict()
+
+    def _should_write(self, user_id: int, chat_id: int) -> bool:
+        last_written = self._last_written.get((key_namespace.get(), user_id, chat_id))
+        return last_written is None or time.monotonic() - last_written >= GROUP_SEEN_REFRESH_SECONDS
+
+    async def _add_user_group(self, user_id: int, chat_id: int) -> None:
+        await rd.add_user_group(user_id, chat_id)
+        # Only a successful write is remembered, a failed one is retried with the next update.
+        key = (key_namespace.get(), user_id, chat_id)
+        self._last_written[key] = time.monotonic()
+        self._last_written.move_to_end(key)
+        if len(self._last_written) > GROUP_SEEN_CACHE_SIZE:
+            self._last_written.popitem(last=False)
+
+    async def pre_process(self, update, data):
+        # The index is only a convenience, it's not written while redis is unhealthy.
+        if not redis_breaker.is_closed:
+            return None
+        try:
+            if isinstance(update, ChatMemberUpdated):
+                member = update.new_chat_member
+                if member.status in ("left", "kicked"):
+                    self._last_written.pop((key_namespace.get(), member.user.id, update.chat.id), None)
+                    await rd.remove_user_group(member.user.id, update.chat.id)
+                elif not member.user.is_bot and self._should_write(member.user.id, update.chat.id):
+                    await self._add_user_group(member.user.id, update.chat.id)
+
+            elif (update.chat.type in ("group", "supergroup") and update.from_user is not None
+                    and not update.from_user.is_bot
+                    and self._should_write(update.from_user.id, update.chat.id)):
+                await self._add_user_group(update.from_user.id, update.chat.id)
+
+        except Exception as ex:
+            error_logger.error(ex, exc_info=True)
+
+    async def post_process(self, update, data, exception):
+        pass
+
+class LoadSheddingMiddleware(BaseMiddleware):
+    """Drop messages and callback queries while the redis circuit is open.
+
+    Every handler of them reads or writes redis (the FSM state at least), so instead
+    of queueing updates which would fail anyway, private chats get a "try again
+    shortly" notice (at most once per UNAVAILABLE_NOTICE_SECONDS) and group updates
+    are dropped silently. Once a probe is due updates go through again, see circuit_breaker.py.
+    """
+
+    def __init__(self, bot: AsyncTeleBot):
+        super().__init__()
+        self.update_types = ["message", "callback_query"]
+        self.bot = bot
+        self._last_notice = OrderedDict()
+
+    def _should_notify(self, chat_id: int) -> bool:
+        now = time.monotonic()
+        last_notice = self._last_notice.get(chat_id)
+        if last_notice is not None and now - last_notice < UNAVAILABLE_NOTICE_SECONDS:
+            return False
+        self._last_notice[chat_id] = now
+        self._last_notice.move_to_end(chat_id)
+        if len(self._last_notice) > UNAVAILABLE_NOTICE_CACHE_SIZE:
+            self._last_notice.popitem(last=False)
+        return True
+
+    async def pre_process(self, update, data):
+        if not redis_breaker.is_open:
+            return None
+
+        if isinstance(update, CallbackQuery):
+            await notify_service_unavailable(self.bot, update)
+        elif update.chat.type == "private" and self._should_notify(update.chat.id):
+            await notify_service_unavailable(self.bot, update)
+        return CancelUpdate()
+
+    async def post_process(self, update, data, exception):
+        pass
+
+async def notify_service_unavailable(bot: AsyncTeleBot, update) -> None:
+    """Ask the user to try again shortly, used when a circuit breaker is open."""
+    try:
+        if isinstance(update, CallbackQuery):
+            await bot.answer_callback_query(
+                callback_query_id=update.id,
+                text=messages.SERVICE_UNAVAILABLE_MESSAGE,
+                show_alert=True
+            )
+        else:
+            await bot.send_message(chat_id=update.chat.id, text=messages.SERVICE_UNAVAILABLE_MESSAGE)
+    except Exception as ex:
+        error_logger.error(ex, exc_info=True)
+
+    return None
+
+_loop_profilers = {}
 
-bot.setup_middleware(StateMiddleware(bot))
+def get_loop_profiler(bot: AsyncTeleBot):
+    """Return the event loop profiler of `bot`, profiler.py is only imported when it's first needed."""
+    if bot.token not in _loop_profilers:
+        import profiler
+        _loop_profilers[bot.token] = profiler.LoopProfiler(bot)
+    return _loop_profilers[bot.token]
 
+_bot_usernames = {}
 
-@bot.message_handler(func=lambda mg: mg.text == "Cancel")
-async def cancel_operation(message: Message, state: StateContext):
+async def get_bot_username(bot: AsyncTeleBot) -> str:
+    """Return the bot's username, it's requested from telegram only once per bot."""
+    if bot.token not in _bot_usernames:
+        _bot_usernames[bot.token] = (await bot.get_me()).username
+    return _bot_usernames[bot.token]
+
+
+async def create_full_message_url(bot: AsyncTeleBot, group_chat_id, message_id) -> str:
+    """Return the deep link which delivers a private message in the bot's private chat."""
+    return "https://t.me/{0}?start={1}{2}_{3}".format(
+        await get_bot_username(bot), FULL_PRIVATE_MESSAGE_PREFIX, group_chat_id, message_id
+    )
+
+
+async def cancel_operation(message: Message, state: StateContext, bot: AsyncTeleBot):
     """Cancel the user's state."""
 
     await state.delete()
@@ -89,34 +233,213 @@ async def cancel_operation(message: Message, state: StateContext):
     return None
 
 
-@bot.message_handler(commands=["private_message"], chat_types=["private"])
-async def start_private_message_process(message: Message, state: StateContext):
-    """Initiate the private message process by requesting target group selection.
+async def profile_event_loop(message: Message, bot: AsyncTeleBot):
+    """Profile the event loop for some seconds and send the result to the admin.
 
-    This command handler starts the PrivateMessageStates workflow in private chat.
-    It requests the user to choose a group as shared_chat via a keyboard button.
+    Usage: /profile [seconds], only available to ADMIN_USER_IDS.
+    The folded stacks file can be opened with flamegraph.pl or speedscope.
 
     Raises:
-        Exception: Logs any exceptions that occur during message sending or state transition.
+        Exception: Logs any exceptions that occur during profiling or message sending.
+    """
+    try:
+        import profiler
+        loop_profiler = get_loop_profiler(bot)
+        if loop_profiler.running:
+            await bot.send_message(chat_id=message.chat.id, text=messages.PROFILE_ALREADY_RUNNING)
+            return None
+
+        arguments = message.text.split()
+        seconds = float(arguments[1]) if len(arguments) > 1 else DEFAULT_PROFILE_SECONDS
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=messages.PROFILE_STARTED.format(seconds)
+        )
+
+        summary = await loop_profiler.run(seconds)
+
+        await bot.send_message(chat_id=message.chat.id, text=profiler.format_summary(summary))
+        with open(summary["folded_path"], "rb") as folded_file:
+            await bot.send_document(chat_id=message.chat.id, document=folded_file)
+
+    except Exception as ex:
+        error_logger.error(ex, exc_info=True)
+
+    return None
+
+
+async def send_full_private_message(message: Message, bot: AsyncTeleBot):
+    """Deliver a long private message in the recipient's private chat.
+
+    The "Read the full message." button under a group notification opens the bot with
+    a deep link whose start parameter is pm_<group chat id>_<message id>.
+    The redis key contains the recipient's user id, so only the recipient finds the message.
+
+    Workflow:
+        1. Parses the group chat ID and message ID from the start parameter
+        2. Streams the stored message from redis piece by piece
+        3. Sends it in as many text messages as LIMIT_TEXT_MESSAGE_CHARS requires
+        4. If nothing is stored (expired or not addressed to the user), informs the user
+
+    Raises:
+        Exception: Logs any exceptions that occur during processing.
     """
     try:
+        parameter = message.text.split(maxsplit=1)[-1][len(FULL_PRIVATE_MESSAGE_PREFIX):]
+        group_chat_id, _, message_id = parameter.rpartition("_")
+
+        buffer = ""
+        sent_any = False
+        async for piece in rd.stream_private_message(
+                target_user_id=str(message.from_user.id),
+                target_group_chat_id=group_chat_id,
+                private_message_id=message_id):
+            buffer += piece
+            while len(buffer) >= LIMIT_TEXT_MESSAGE_CHARS:
+                await bot.send_message(
+                    chat_id=message.chat.id,
+                    text=buffer[:LIMIT_TEXT_MESSAGE_CHARS]
+                )
+                buffer = buffer[LIMIT_TEXT_MESSAGE_CHARS:]
+                sent_any = True
+
+        if buffer:
+            await bot.send_message(chat_id=message.chat.id, text=buffer)
+        elif not sent_any:
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=messages.PRIVATE_MESSAGE_NOT_FOUND
+            )
+
+    except CircuitOpenError:
+        await notify_service_unavailable(bot, message)
+    except Exception as ex:
+        error_logger.error(ex, exc_info=True)
+
+    return None
+
+
+async def build_inbox_page(bot: AsyncTeleBot, user_id: int, page: int):
+    """Return the text and keyboard of one /inbox page of `user_id`."""
+    total, entries = await rd.get_inbox(
+        target_user_id=str(user_id),
+        page=page,
+        page_size=INBOX_PAGE_SIZE
+    )
+    if not total:
+        return messages.INBOX_EMPTY_MESSAGE, None
+
+    pages = (total + INBOX_PAGE_SIZE - 1) // INBOX_PAGE_SIZE
+    if page >= pages:
+        # Messages expired since the page was shown.
+        return await build_inbox_page(bot, user_id, pages - 1)
+    group_titles = sql_database.get_group_titles(
+        [int(entry.group_chat_id) for entry in entries]
+    )
+
+    text = messages.INBOX_HEADER.format(total, page + 1, pages)
+    for index, entry in enumerate(entries, start=page * INBOX_PAGE_SIZE + 1):
+        private_message = entry.private_message_text
+        if len(private_message) > LIMIT_INBOX_PREVIEW_CHARS:
+            private_message = private_message[:LIMIT_INBOX_PREVIEW_CHARS - 1] + "…"
+            private_message += "\n" + messages.INBOX_FULL_MESSAGE_LINK.format(
+                await create_full_message_url(bot, entry.group_chat_id, entry.private_message_id)
+            )
+        text += messages.INBOX_ENTRY.format(
+            index,
+            group_titles.get(int(entry.group_chat_id), entry.group_chat_id),
+            private_message
+        )
+    keyboard = keyboards.create_inbox_keyboard(page, pages) if pages > 1 else None
+    return text, keyboard
+
+
+async def show_inbox(message: Message, bot: AsyncTeleBot):
+    """List the unexpired private messages addressed to the user across all groups.
+
+    Messages are read from the user's inbox index in redis, a page at a time,
+    so the recipient doesn't need to click every "Show the message." button.
+
+    Raises:
+        Exception: Logs any exceptions that occur during processing.
+    """
+    try:
+        text, keyboard = await build_inbox_page(bot, message.from_user.id, page=0)
         await bot.send_message(
             chat_id=message.chat.id,
-            text=messages.REQUEST_GROUP_MESSAGE,
-            reply_markup=keyboards.create_request_chat_keyboard()
+            text=text,
+            reply_markup=keyboard
+        )
+
+    except CircuitOpenError:
+        await notify_service_unavailable(bot, message)
+    except Exception as ex:
+        error_logger.error(ex, exc_info=True)
+
+    return None
+
+
+async def change_inbox_page(call: CallbackQuery, bot: AsyncTeleBot):
+    """Show another page of the /inbox message.
+
+    Raises:
+        Exception: Logs any exceptions that occur during processing.
+    """
+    try:
+        page = int(call.data.split(":")[-1])
+        text, keyboard = await build_inbox_page(bot, call.from_user.id, page)
+        await bot.edit_message_text(
+            text=text,
+            chat_id=call.message.chat.id,
+            message_id=call.message.id,
+            reply_markup=keyboard
         )
+        await bot.answer_callback_query(callback_query_id=call.id)
+
+    except CircuitOpenError:
+        await notify_service_unavailable(bot, call)
+    except Exception as ex:
+        error_logger.error(ex, exc_info=True)
+
+    return None
+
+
+async def start_private_message_process(message: Message, state: StateContext, bot: AsyncTeleBot):
+    """Initiate the private message process by requesting target group selection.
+
+    This command handler starts the PrivateMessageStates workflow in private chat.
+    If the bot has seen the user in registered groups, it offers them as an inline list
+    (see GroupMembershipMiddleware), otherwise it requests the user to choose a group
+    as shared_chat via a keyboard button.
+
+    Raises:
+        Exception: Logs any exceptions that occur during message sending or state transition.
+    """
+    try:
+        group_selection_keyboard = await build_group_selection(message.from_user.id, page=0)
+        if group_selection_keyboard is not None:
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=messages.REQUEST_GROUP_FROM_LIST_MESSAGE,
+                reply_markup=group_selection_keyboard
+            )
+        else:
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=messages.REQUEST_GROUP_MESSAGE,
+                reply_markup=keyboards.create_request_chat_keyboard()
+            )
         await state.set(PrivateMessageStates.shared_user)
 
+    except CircuitOpenError:
+        await notify_service_unavailable(bot, message)
     except Exception as ex:
         error_logger.error(ex, exc_info=True)
 
     return None
 
 
-@bot.message_handler(
-    content_types=["chat_shared"], chat_types=["private"],
-    state=PrivateMessageStates.shared_user)
-async def recieve_target_chat(message: Message, state: StateContext):
+async def recieve_target_chat(message: Message, state: StateContext, bot: AsyncTeleBot):
     """Process a shared chat selection and validate bot membership.
 
     This handler recieves the group chat shared by the user via a chat_shared content type.
@@ -134,36 +457,123 @@ async def recieve_target_chat(message: Message, state: StateContext):
         5. Maintains the shared_user state for the next step
     """
     try:
-        if not await rd.check_chat_id(message.chat_shared.chat_id):
+        await select_target_group(bot, message.chat.id, message.chat_shared.chat_id, state)
+
+    except CircuitOpenError:
+        await notify_service_unavailable(bot, message)
+    except Exception as ex:
+        error_logger.error(ex, exc_info=True)
+
+    return None
+
+
+async def select_target_group(bot: AsyncTeleBot, chat_id: int, group_chat_id: int, state: StateContext):
+    """Validate the chosen group and ask for the recipient, see recieve_target_chat."""
+    if not await rd.check_chat_id(group_chat_id):
+        await bot.send_message(
+            chat_id=chat_id,
+            text=messages.BOT_NOT_JOINED_MESSAGE
+        )
+        return None
+
+    await state.add_data(
+        target_group_chat_id=group_chat_id,
+        target_group_title=sql_database.get_group_title(group_chat_id),
+        target_group_username = sql_database.get_group_username(group_chat_id)
+    )
+
+    await bot.send_message(
+        chat_id=chat_id,
+        text=messages.REQUEST_USER_MESSAGE,
+        reply_markup=keyboards.create_request_users_keyboard()
+    )
+    await state.set(PrivateMessageStates.shared_user)
+    return None
+
+
+async def build_group_selection(user_id: int, page: int):
+    """Return the group selection keyboard page of `user_id`, None if no group is known."""
+    group_chat_ids = await rd.get_user_groups(user_id)
+    if not group_chat_ids:
+        return None
+
+    pages = (len(group_chat_ids) + GROUP_SELECTION_PAGE_SIZE - 1) // GROUP_SELECTION_PAGE_SIZE
+    page = min(page, pages - 1)
+    page_chat_ids = [
+        int(chat_id) for chat_id in
+        group_chat_ids[page * GROUP_SELECTION_PAGE_SIZE:(page + 1) * GROUP_SELECTION_PAGE_SIZE]
+    ]
+    group_titles = sql_database.get_group_titles(page_chat_ids)
+    return keyboards.create_group_selection_keyboard(
+        [(chat_id, group_titles.get(chat_id) or str(chat_id)) for chat_id in page_chat_ids],
+        page,
+        pages
+    )
+
+
+async def choose_target_group(call: CallbackQuery, state: StateContext, bot: AsyncTeleBot):
+    """Handle a group chosen from the group selection list of start_private_message_process.
+
+    "pick_group:other" falls back to choosing the group with KeyboardButtonRequestChat.
+    The callback data comes from the client, so the group is only accepted if the
+    user was seen in it, like KeyboardButtonRequestChat only offers the user's chats.
+
+    Raises:
+        Exception: Logs any exceptions that occur during processing.
+    """
+    try:
+        await bot.answer_callback_query(callback_query_id=call.id)
+        group_chat_id = call.data.split(":")[-1]
+        if group_chat_id == "other":
             await bot.send_message(
-                chat_id=message.chat.id,
-                text=messages.BOT_NOT_JOINED_MESSAGE
+                chat_id=call.message.chat.id,
+                text=messages.REQUEST_GROUP_MESSAGE,
+                reply_markup=keyboards.create_request_chat_keyboard()
             )
             return None
 
-        await state.add_data(
-            target_group_chat_id=message.chat_shared.chat_id,
-            target_group_title=sql_database.get_group_title(message.chat_shared.chat_id),
-            target_group_username = sql_database.get_group_username(message.chat_shared.chat_id)
-        )
+        if not await rd.has_user_group(call.from_user.id, group_chat_id):
+            await bot.send_message(
+                chat_id=call.message.chat.id,
+                text=messages.SENDER_NOT_JOINED_MESSAGE
+            )
+            return None
 
-        await bot.send_message(
-            chat_id=message.chat.id,
-            text=messages.REQUEST_USER_MESSAGE,
-            reply_markup=keyboards.create_request_users_keyboard()
-        )
-        await state.set(PrivateMessageStates.shared_user)
+        await select_target_group(bot, call.message.chat.id, int(group_chat_id), state)
+
+    except CircuitOpenError:
+        await notify_service_unavailable(bot, call.message)
+    except Exception as ex:
+        error_logger.error(ex, exc_info=True)
+
+    return None
+
+
+async def change_group_selection_page(call: CallbackQuery, bot: AsyncTeleBot):
+    """Show another page of the group selection list.
+
+    Raises:
+        Exception: Logs any exceptions that occur during processing.
+    """
+    try:
+        keyboard = await build_group_selection(call.from_user.id, int(call.data.split(":")[-1]))
+        if keyboard is not None:
+            await bot.edit_message_reply_markup(
+                chat_id=call.message.chat.id,
+                message_id=call.message.id,
+                reply_markup=keyboard
+            )
+        await bot.answer_callback_query(callback_query_id=call.id)
 
+    except CircuitOpenError:
+        await notify_service_unavailable(bot, call)
     except Exception as ex:
         error_logger.error(ex, exc_info=True)
 
     return None
 
 
-@bot.message_handler(
-    content_types=["users_shared"], chat_types=["private"],
-    state=PrivateMessageStates.shared_user)
-async def recieve_target_user(message: Message, state: StateContext):
+async def recieve_target_user(message: Message, state: StateContext, bot: AsyncTeleBot):
     """Process a shared user selection and validate group membership.
 
     This handler receives user information shared via the users_shared content type.
@@ -210,15 +620,15 @@ async def recieve_target_user(message: Message, state: StateContext):
         )
         await state.set(PrivateMessageStates.private_message)
 
+    except CircuitOpenError:
+        await notify_service_unavailable(bot, message)
     except Exception as ex:
         error_logger.error(ex, exc_info=True)
 
     return None
 
 
-@bot.message_handler(content_types=['text'], chat_types=["private"],
-        state=PrivateMessageStates.private_message)
-async def recieve_private_message(message: Message, state: StateContext):
+async def recieve_private_message(message: Message, state: StateContext, bot: AsyncTeleBot):
     """Recieve and validate the private message content from the user.
 
     This handler captures the main message text that will be sent to the target user
@@ -230,7 +640,8 @@ async def recieve_private_message(message: Message, state: StateContext):
         propagate them to maintain user experience.
 
     Workflow:
-        1. Validates message length and warns if exceeded (non-blocking)
+        1. Validates message length and informs the user that only a preview fits
+            in the group alert if exceeded (non-blocking)
         2. Stores the private message text in PrivateMessageStates state
         3. Prompts user to provide an optional description with cancel option
             if the user doesn't want to provide any description
@@ -257,15 +668,15 @@ async def recieve_private_message(message: Message, state: StateContext):
 
         await state.set(PrivateMessageStates.description)
 
+    except CircuitOpenError:
+        await notify_service_unavailable(bot, message)
     except Exception as ex:
         error_logger.error(ex, exc_info=True)
 
     return None
 
 
-@bot.message_handler(content_types=["text"], chat_types=["private"],
-        state=PrivateMessageStates.description)
-async def recieve_description(message: Message, state: StateContext):
+async def recieve_description(message: Message, state: StateContext, bot: AsyncTeleBot):
     """Receive and process the optional description for the private message.
 
     This handler captures the description text that provides concise decription
@@ -332,14 +743,15 @@ async def recieve_description(message: Message, state: StateContext):
         )
         await state.set(PrivateMessageStates.affirmation)
 
+    except CircuitOpenError:
+        await notify_service_unavailable(bot, message)
     except Exception as ex:
         error_logger.error(ex, exc_info=True)
 
     return None
 
 
-@bot.callback_query_handler(state=PrivateMessageStates.affirmation)
-async def verify_private_message(call: CallbackQuery, state: StateContext):
+async def verify_private_message(call: CallbackQuery, state: StateContext, bot: AsyncTeleBot):
     """Handler user affirmation decision for sending the private message.
 
     This callback handler processes the user's final confirmation (yes/no) to send
@@ -385,12 +797,31 @@ async def verify_private_message(call: CallbackQuery, state: StateContext):
                 )
             )
 
-            await rd.store_private_message(
-                target_user_id=target_user_id,
-                target_group_chat_id=target_group_chat_id,
-                private_message_id=sent_message_info.id,
-                private_message_text=private_message
-            )
+            try:
+                await rd.store_private_message(
+                    target_user_id=target_user_id,
+                    target_group_chat_id=target_group_chat_id,
+                    private_message_id=sent_message_info.id,
+                    private_message_text=private_message
+                )
+            except CircuitOpenError:
+                # Without the stored message the notification's button can't work.
+                await bot.delete_message(chat_id=target_group_chat_id, message_id=sent_message_info.id)
+                raise
+
+            # The alert only shows a preview of long messages, so a deep link to the
+            # full text is added once the id of the group message is known.
+            if len(private_message) > LIMIT_PRIVATE_MESSAGE_CHARS:
+                await bot.edit_message_reply_markup(
+                    chat_id=target_group_chat_id,
+                    message_id=sent_message_info.id,
+                    reply_markup=keyboards.create_private_message_keyboard(
+                        user_id=target_user_id,
+                        full_message_url=await create_full_message_url(
+                            bot, target_group_chat_id, sent_message_info.id
+                        )
+                    )
+                )
 
             await asyncio.sleep(2) #Prevent too many reqeusts error (429 Http code)
 
@@ -399,6 +830,7 @@ async def verify_private_message(call: CallbackQuery, state: StateContext):
                 chat_id=call.message.chat.id,
                 text=messages.SENT_TO_GROUP,
                 reply_markup=keyboards.create_linked_message_keyboard(
+                    group_chat_id=target_group_chat_id,
                     group_username=target_group_username,
                     message_id=sent_message_info.id
                 )
@@ -413,14 +845,15 @@ async def verify_private_message(call: CallbackQuery, state: StateContext):
 
         await state.delete()
 
+    except CircuitOpenError:
+        await notify_service_unavailable(bot, call)
     except Exception as ex:
         error_logger.error(ex, exc_info=True)
 
     return None
 
 
-@bot.message_handler(state="*", chat_types=["private"])
-async def warn_user(message: Message):
+async def warn_user(message: Message, bot: AsyncTeleBot):
     """Global fallback handler for unexpected messages in private chats.
 
     This handler catches any message that doesn't match other specific handlers
@@ -430,10 +863,13 @@ async def warn_user(message: Message):
     Note:
         This handler should have lower priority than specific state handlers
         to ensure it only catches truly unexpected messages.
+        It's shed (nothing is sent) while redis or the database is unhealthy.
 
     Raises:
         Exception: Logs any exceptions that occur during message sending or state transition.
     """
+    if is_degraded():
+        return None
     try:
         await bot.send_message(
             chat_id=message.chat.id,
@@ -446,8 +882,7 @@ async def warn_user(message: Message):
     return None
 
 
-@bot.callback_query_handler(data_startswith="private_message:", chat_types=["group", "supergroup"])
-async def display_private_message(callback: CallbackQuery):
+async def display_private_message(callback: CallbackQuery, bot: AsyncTeleBot):
     """Handles callback queries for displaying private messages to authorized users.
     
     This handler processes button clicks on messages in groups.
@@ -457,7 +892,8 @@ async def display_private_message(callback: CallbackQuery):
     Workflow:
         1. Extracts group chat ID, target user ID, and message ID from callback data
         2. Verifies if the current user is the intended recipient
-        3. If authorized: retrieves and displays the private message in an alert
+        3. If authorized: retrieves and displays the private message in an alert,
+            long messages are shown as a preview (see send_full_private_message)
         4. If unauthorized: shows a permission denied message
         5. Logs any exceptions that occur during processing
         
@@ -471,14 +907,15 @@ async def display_private_message(callback: CallbackQuery):
         message_id = callback.message.id
 
         if target_user_id == user_id:
-            private_message = await rd.get_private_message(
+            preview = await rd.get_private_message_preview(
                 target_user_id=user_id,
                 target_group_chat_id=group_chat_id,
-                private_message_id=message_id
+                private_message_id=message_id,
+                limit=LIMIT_PRIVATE_MESSAGE_CHARS
             )
             await bot.answer_callback_query(
                 callback_query_id=callback.id,
-                text=private_message,
+                text=preview[0] if preview is not None else messages.PRIVATE_MESSAGE_NOT_FOUND,
                 show_alert=True
             )
         else:
@@ -487,12 +924,13 @@ async def display_private_message(callback: CallbackQuery):
                 text=messages.NOT_ALLOWED_MESSAGE,
                 show_alert=True
             )
+    except CircuitOpenError:
+        await notify_service_unavailable(bot, callback)
     except Exception as ex:
         error_logger.error(ex, exc_info=True)
 
 
-@bot.my_chat_member_handler()
-async def recieve_group_info(message: Message):
+async def recieve_group_info(message: Message, bot: AsyncTeleBot):
     """Handle my_chat_member updates and store neccessary infomration about a group.
 
     Whenever some add the bot to a special group, this handler catches
@@ -508,16 +946,13 @@ async def recieve_group_info(message: Message):
         group_info: ChatFullInfo = await bot.get_chat(message.chat.id)
 
         #Add info to sqlite database
+        #The metadata columns are kept up to date by group_refresher.py
         sql_database.store_group_info(
             chat_id=group_info.id,
-            username=group_info.username,
             chat_type=group_info.type,
-            title=group_info.title,
-            description=group_info.description,
             is_forum=group_info.is_forum,
-            bio=group_info.bio,
             date_membership=str(datetime.now()),
-            json_photos=json.dumps(group_info.photo.__dict__) if group_info.photo is not None else None
+            **group_refresher.get_chat_metadata(group_info)
         )
 
         #Store chat_id in single set redis key
@@ -531,7 +966,116 @@ async def recieve_group_info(message: Message):
     return None
 
 
-if __name__ == "__main__":
-    asyncio.run(bot.infinity_polling())
+def register_handlers(bot: AsyncTeleBot) -> None:
+    """Register every handler of this module on `bot`, in priority order.
+
+    Handlers get the bot that received the update as their `bot` argument,
+    so the same handlers serve any number of bots (see multi_bot.py).
+    """
+    bot.register_message_handler(cancel_operation,
+        func=lambda mg: mg.text == "Cancel", pass_bot=True)
+    bot.register_message_handler(profile_event_loop,
+        commands=["profile"], chat_types=["private"],
+        func=lambda mg: mg.from_user.id in ADMIN_USER_IDS, pass_bot=True)
+    bot.register_message_handler(send_full_private_message,
+        commands=["start"], chat_types=["private"],
+        text_startswith=f"/start {FULL_PRIVATE_MESSAGE_PREFIX}", pass_bot=True)
+    bot.register_message_handler(show_inbox,
+        commands=["inbox"], chat_types=["private"], pass_bot=True)
+    bot.register_callback_query_handler(change_inbox_page, func=None,
+        data_startswith="inbox:page:", pass_bot=True)
+    bot.register_message_handler(start_private_message_process,
+        commands=["private_message"], chat_types=["private"], pass_bot=True)
+    bot.register_callback_query_handler(choose_target_group, func=None,
+        data_startswith="pick_group:", state=PrivateMessageStates.shared_user, pass_bot=True)
+    bot.register_callback_query_handler(change_group_selection_page, func=None,
+        data_startswith="pick_group_page:", state=PrivateMessageStates.shared_user, pass_bot=True)
+    bot.register_message_handler(recieve_target_chat,
+        content_types=["chat_shared"], chat_types=["private"],
+        state=PrivateMessageStates.shared_user, pass_bot=True)
+    bot.register_message_handler(recieve_target_user,
+        content_types=["users_shared"], chat_types=["private"],
+        state=PrivateMessageStates.shared_user, pass_bot=True)
+    bot.register_message_handler(recieve_private_message,
+        content_types=["text"], chat_types=["private"],
+        state=PrivateMessageStates.private_message, pass_bot=True)
+    bot.register_message_handler(recieve_description,
+        content_types=["text"], chat_types=["private"],
+        state=PrivateMessageStates.description, pass_bot=True)
+    bot.register_callback_query_handler(verify_private_message, func=None,
+        state=PrivateMessageStates.affirmation, pass_bot=True)
+    bot.register_message_handler(warn_user,
+        state="*", chat_types=["private"], pass_bot=True)
+    # chat_types can't be used here, callback queries have no chat of their own.
+    bot.register_callback_query_handler(display_private_message,
+        func=lambda call: call.message.chat.type in ("group", "supergroup"),
+        data_startswith="private_message:", pass_bot=True)
+    bot.register_my_chat_member_handler(recieve_group_info, pass_bot=True)
+    return None
+
+
+def create_bot(token: str, namespace: str = "") -> AsyncTeleBot:
+    """Create a bot with its filters, middlewares and handlers.
+
+    Bots sharing one storage need different namespaces, it prefixes their FSM state keys.
+    Their RedisDatabase keys are prefixed by setting redis_database.key_namespace.
+    """
+    bot = AsyncTeleBot(
+        token=token,
+        exception_handler=BotExceptionHandler(),
+        state_storage=storage_backends.create_state_storage(
+            rd.REDIS_URL,
+            prefix=f"{namespace}:telebot" if namespace else "telebot"
+        )
+    )
+
+    bot.add_custom_filter(StateFilter(bot))
+    bot.add_custom_filter(TextStartsFilter())
+    bot.add_custom_filter(CallbackTextStartsFilter())
+
+    bot.setup_middleware(LoadSheddingMiddleware(bot))
+    bot.setup_middleware(StateMiddleware(bot))
+    bot.setup_middleware(GroupMembershipMiddleware())
+
+    register_handlers(bot)
+    return bot
+
+
+async def on_startup():
+    """Prepare everything the handlers need before the first update is processed.
 
+    The storage backend and the SQL engine are built here instead of at import,
+    and the database schema revision is checked once.
+    """
+    await rd.connect()
+    startup_timer.mark("storage backend connected")
+
+    await asyncio.to_thread(sql_database.check_schema_revision)
+    startup_timer.mark("database engine created and schema checked")
+
+    logger.info(startup_timer.report())
+    return None
+
+
+async def main():
+    if not TOKEN:
+        raise ValueError("The token doesn't exist.")
+    bot = create_bot(TOKEN)
+    startup_timer.mark("bot created")
 
+    await on_startup()
+
+    # Optional local HTTP hook for the profiler: GET /profile?seconds=N
+    profiler_http_port = os.environ.get("PROFILER_HTTP_PORT", None)
+    if profiler_http_port:
+        import profiler
+        await profiler.start_http_hook(get_loop_profiler(bot), int(profiler_http_port))
+
+    # Keeps the groups table up to date, the reference keeps the task alive.
+    refresher_task = group_refresher.start_group_refresher({"": bot})
+
+    await bot.infinity_polling(allowed_updates=ALLOWED_UPDATES)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -24,6 +24,11 @@ REQUEST_GROUP_MESSAGE = f"""
 Choose a group you want to send your private message.
 """
 
+REQUEST_GROUP_FROM_LIST_MESSAGE = """
+Choose a group you want to send your private message.
+Only groups where the bot has seen you are listed.
+"""
+
 REQUEST_USER_MESSAGE = """
 Choose a user to send your private message.
 """
@@ -36,13 +41,18 @@ USER_NOT_JOINED_MESSAGE = """
 The user doesn't join this group.
 """
 
+SENDER_NOT_JOINED_MESSAGE = """
+You can only choose a group the bot has seen you in.
+"""
+
 REQUEST_PRIVATE_MESSAGE = f"""
 Write your private message for the user.
 """
 
 WARNING_LIMIT_PRIVATE_MESSAGE ="""
-Youre private message must be less than *{0}*
+Your private message is longer than *{0}* characters.
 Your current length of private message: *{1}*
+The user sees a preview in the group and can read the full message in the bot's private chat.
 """
 
 GROUP_NOTIFICATION_MESSAGE = """
@@ -70,3 +80,34 @@ The operation has been canceled.
 NOT_ALLOWED_MESSAGE = """
 Sorry! This message isn't for you.
 """
+
+PRIVATE_MESSAGE_NOT_FOUND = """
+This message doesn't exist anymore or isn't for you.
+"""
+
+PROFILE_STARTED = """
+Profiling the event loop for {0} seconds.
+"""
+
+PROFILE_ALREADY_RUNNING = """
+A profile is already running, wait until it's finished.
+"""
+
+INBOX_EMPTY_MESSAGE = """
+You don't have any pending private message.
+"""
+
+INBOX_HEADER = """You have {0} pending private messages (page {1}/{2}):
+"""
+
+INBOX_ENTRY = """
+{0}. In {1}:
+{2}
+"""
+
+INBOX_FULL_MESSAGE_LINK = """Read the full message: {0}
+"""
+
+SERVICE_UNAVAILABLE_MESSAGE = """
+The bot is busy right now, please try again shortly.
+"""
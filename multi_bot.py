@@ -0,0 +1,82 @@
+"""
+Host several bots (brands) on one event loop.
+
+All bots share the process, the redis connection pool and the SQLAlchemy
+engine, while each one keeps:
+    - its own key namespace: RedisDatabase keys ("<name>:groups:chat_id",
+      "<name>:reciever_user:...") and FSM state keys ("<name>:telebot...")
+    - its own outbound request budget (rate_limit.py)
+
+Bots are configured with the BOT_TOKENS environment variable, a comma
+separated list of name=token pairs. Names may contain letters, digits and "_".
+
+Usage:
+    export BOT_TOKENS='brand_a=123:AAA,brand_b=456:BBB'
+    python3 multi_bot.py
+"""
+
+import os
+import re
+import asyncio
+from typing import Dict
+
+from telebot.async_telebot import AsyncTeleBot
+
+import rate_limit
+import redis_database
+import group_refresher
+from main import ALLOWED_UPDATES, create_bot, on_startup, startup_timer, logger
+
+NAMESPACE_PATTERN = re.compile(r"^[A-Za-z0-9_]+$")
+REQUESTS_PER_SECOND = float(os.environ.get("BOT_REQUESTS_PER_SECOND", rate_limit.DEFAULT_REQUESTS_PER_SECOND))
+
+
+def parse_bot_tokens(value: str) -> Dict[str, str]:
+    """Parse "name=token,name=token" into {name: token}."""
+    tokens = {}
+    for pair in value.split(","):
+        if not pair.strip():
+            continue
+        name, separator, token = pair.strip().partition("=")
+        if not separator or not token:
+            raise ValueError(f"Expected name=token in BOT_TOKENS, got {pair!r}.")
+        if not NAMESPACE_PATTERN.match(name):
+            raise ValueError(f"Invalid bot name {name!r} in BOT_TOKENS.")
+        if name in tokens:
+            raise ValueError(f"Bot name {name!r} is used more than once in BOT_TOKENS.")
+        tokens[name] = token
+    return tokens
+
+
+async def run_bot(bot: AsyncTeleBot, namespace: str) -> None:
+    # Each bot runs in its own task, so the namespace set here is seen by every
+    # handler task the bot's polling creates, and by nothing else.
+    redis_database.key_namespace.set(namespace)
+    logger.info(f"Bot {namespace} started polling.")
+    await bot.infinity_polling(allowed_updates=ALLOWED_UPDATES)
+
+
+async def main() -> None:
+    tokens = parse_bot_tokens(os.environ.get("BOT_TOKENS", ""))
+    if not tokens:
+        raise ValueError("BOT_TOKENS doesn't contain any bot.")
+
+    bots = {}
+    for namespace, token in tokens.items():
+        bots[namespace] = create_bot(token, namespace=namespace)
+        rate_limit.set_request_budget(token, rate=REQUESTS_PER_SECOND)
+    startup_timer.mark(f"{len(bots)} bots created")
+
+    await on_startup()
+
+    # One refresher for the shared groups table, each group is read by a bot registered in it.
+    refresher_task = group_refresher.start_group_refresher(bots)
+
+    await asyncio.gather(*(
+        asyncio.create_task(run_bot(bot, namespace), name=f"bot-{namespace}")
+        for namespace, bot in bots.items()
+    ))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,303 @@
+"""
+On-demand sampling profiler for the bot's event loop.
+
+Nothing here runs until a profile is requested (the admin /profile command or
+the optional local HTTP hook), so there is no overhead while it's turned off.
+
+While a profile runs:
+    - a sampler thread records the event loop thread's stack every SAMPLE_INTERVAL
+      seconds and the CPU time the loop thread used since the previous sample,
+    - every registered handler is temporarily wrapped to measure its wall time,
+    - the sampler reports callbacks that block the loop for longer than
+      SLOW_CALLBACK_DURATION, like the synchronous sql_database queries, from
+      how long the samples keep seeing the same callback.
+
+asyncio's debug mode isn't used for the slow callbacks, it records a traceback
+for every handle and coroutine, which would slow down the bot and distort the
+wall and CPU times being measured.
+
+The result is written as folded stacks ("frame;frame;frame count" lines), the
+input format of flamegraph.pl and speedscope, plus a JSON summary next to it.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import functools
+import threading
+from datetime import datetime
+from typing import Dict, List
+
+PROFILES_DIRECTORY = "profiles"
+SAMPLE_INTERVAL = 0.005 # Seconds between two stack samples.
+SLOW_CALLBACK_DURATION = 0.05 # Callbacks blocking the loop longer than this are reported.
+MAX_PROFILE_SECONDS = 300
+IDLE_FRAMES = {"select", "poll", "epoll", "_run_once"} # Innermost frames of an idle loop.
+HANDLE_RUN_FILE = os.path.join("asyncio", "events.py") # Handle._run, which runs every loop callback.
+
+
+def _get_frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})".replace(";", ",")
+
+
+class _SlowCallbackTracker():
+    """Find callbacks which block the loop from the stack samples.
+
+    Every callback runs in its own Handle._run frame, so a callback is slow when
+    the same frame is seen in the samples for longer than SLOW_CALLBACK_DURATION.
+    """
+
+    def __init__(self):
+        self.slow_callbacks: List[str] = []
+        self._frame = None # Handle._run frame of the current callback, kept so its id isn't reused.
+        self._label = None
+        self._first_seen = 0.0
+        self._last_seen = 0.0
+
+    def finish(self) -> None:
+        """Report the current callback if it was slow."""
+        if self._frame is not None and self._last_seen - self._first_seen > SLOW_CALLBACK_DURATION:
+            self.slow_callbacks.append(
+                f"{self._label} took at least {self._last_seen - self._first_seen:.3f} seconds"
+            )
+        self._frame = None
+
+    def sample(self, frame, now: float) -> None:
+        """Record the stack of a sample of the loop thread, from its innermost frame."""
+        callback_frame = None
+        while frame is not None:
+            if frame.f_code.co_name == "_run" and frame.f_code.co_filename.endswith(HANDLE_RUN_FILE):
+                break
+            callback_frame = frame
+            frame = frame.f_back
+
+        if frame is None or frame is not self._frame:
+            self.finish()
+        if frame is None:
+            return
+        if self._frame is None:
+            self._frame = frame
+            self._label = _get_frame_label(callback_frame) if callback_frame is not None else "callback"
+            self._first_seen = now
+        self._last_seen = now
+
+
+class HandlerStatistics():
+    def __init__(self):
+        self.calls = 0
+        self.wall_time = 0.0
+        self.max_wall_time = 0.0
+        self.cpu_time = 0.0 # Estimated from the samples the handler was running in.
+        self.samples = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "wall_seconds": round(self.wall_time, 6),
+            "max_wall_seconds": round(self.max_wall_time, 6),
+            "cpu_seconds": round(self.cpu_time, 6),
+            "samples": self.samples,
+        }
+
+
+class LoopProfiler():
+    """Profile the event loop of `bot` for a limited time."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._running = False
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def _handler_lists(self) -> List[list]:
+        return [
+            value for name, value in vars(self.bot).items()
+            if name.endswith("_handlers") and isinstance(value, list)
+        ]
+
+    def _wrap_handlers(self, statistics: Dict[str, HandlerStatistics]) -> Dict[int, dict]:
+        """Replace every handler function with a timing wrapper, return what to restore."""
+        originals = {}
+        for handlers in self._handler_lists():
+            for handler in handlers:
+                if not isinstance(handler, dict) or "function" not in handler:
+                    continue
+                function = handler["function"]
+                handler_statistics = statistics.setdefault(function.__name__, HandlerStatistics())
+
+                # functools.wraps keeps the signature, telebot inspects it to pass state/bot.
+                @functools.wraps(function)
+                async def timed(*args, _function=function, _statistics=handler_statistics, **kwargs):
+                    started = time.perf_counter()
+                    try:
+                        return await _function(*args, **kwargs)
+                    finally:
+                        elapsed = time.perf_counter() - started
+                        _statistics.calls += 1
+                        _statistics.wall_time += elapsed
+                        _statistics.max_wall_time = max(_statistics.max_wall_time, elapsed)
+
+                originals[id(handler)] = (handler, function)
+                handler["function"] = timed
+        return originals
+
+    @staticmethod
+    def _restore_handlers(originals: Dict[int, dict]) -> None:
+        for handler, function in originals.values():
+            handler["function"] = function
+
+    def _sample(self, loop_thread_id: int, stop: threading.Event, handler_codes: Dict[object, str],
+            statistics: Dict[str, HandlerStatistics], stacks: Dict[str, int],
+            slow_callback_tracker: _SlowCallbackTracker) -> None:
+        try:
+            cpu_clock = time.pthread_getcpuclockid(loop_thread_id)
+        except (AttributeError, OSError):
+            cpu_clock = None # CPU time isn't available on this platform.
+        last_cpu = time.clock_gettime(cpu_clock) if cpu_clock is not None else 0.0
+
+        while not stop.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(loop_thread_id)
+            if frame is None:
+                break
+
+            cpu = time.clock_gettime(cpu_clock) if cpu_clock is not None else 0.0
+            cpu_delta = cpu - last_cpu
+            last_cpu = cpu
+
+            if frame.f_code.co_name in IDLE_FRAMES:
+                slow_callback_tracker.finish()
+                continue
+            slow_callback_tracker.sample(frame, time.perf_counter())
+
+            labels = []
+            running_handlers = set()
+            while frame is not None:
+                labels.append(_get_frame_label(frame))
+                if frame.f_code in handler_codes:
+                    running_handlers.add(handler_codes[frame.f_code])
+                frame = frame.f_back
+
+            stack = ";".join(reversed(labels))
+            stacks[stack] = stacks.get(stack, 0) + 1
+            for name in running_handlers:
+                statistics[name].samples += 1
+                statistics[name].cpu_time += cpu_delta
+        slow_callback_tracker.finish()
+
+    async def run(self, seconds: float) -> dict:
+        """Profile the running event loop for `seconds` and write the result files.
+
+        Returns the summary, including the paths of the written files.
+        """
+        if self._running:
+            raise RuntimeError("A profile is already running.")
+        seconds = min(max(seconds, 1), MAX_PROFILE_SECONDS)
+        self._running = True
+
+        statistics: Dict[str, HandlerStatistics] = {}
+        stacks: Dict[str, int] = {}
+        originals = self._wrap_handlers(statistics)
+        handler_codes = {
+            function.__code__: function.__name__ for _, function in originals.values()
+        }
+
+        slow_callback_tracker = _SlowCallbackTracker()
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample,
+            args=(threading.get_ident(), stop, handler_codes, statistics, stacks, slow_callback_tracker),
+            name="loop-profiler",
+            daemon=True
+        )
+        started_at = datetime.now()
+        try:
+            sampler.start()
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            self._restore_handlers(originals)
+            self._running = False
+
+        return await asyncio.to_thread(
+            self._write_result, started_at, seconds, stacks, statistics,
+            slow_callback_tracker.slow_callbacks
+        )
+
+    @staticmethod
+    def _write_result(started_at: datetime, seconds: float, stacks: Dict[str, int],
+            statistics: Dict[str, HandlerStatistics], slow_callbacks: List[str]) -> dict:
+        os.makedirs(PROFILES_DIRECTORY, exist_ok=True)
+        base_name = os.path.join(PROFILES_DIRECTORY, started_at.strftime("profile-%Y%m%d-%H%M%S"))
+
+        folded_path = base_name + ".folded"
+        with open(folded_path, "w", encoding="utf-8") as folded_file:
+            for stack, count in sorted(stacks.items(), key=lambda item: item[1], reverse=True):
+                folded_file.write(f"{stack} {count}\n")
+
+        summary = {
+            "started_at": str(started_at),
+            "seconds": seconds,
+            "sample_interval": SAMPLE_INTERVAL,
+            "busy_samples": sum(stacks.values()),
+            "handlers": {
+                name: handler_statistics.to_dict()
+                for name, handler_statistics in statistics.items()
+                if handler_statistics.calls or handler_statistics.samples
+            },
+            "slow_callbacks": slow_callbacks,
+            "folded_path": folded_path,
+            "summary_path": base_name + ".json",
+        }
+        with open(summary["summary_path"], "w", encoding="utf-8") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+        return summary
+
+
+async def start_http_hook(profiler: LoopProfiler, port: int, host: str = "127.0.0.1"):
+    """Serve GET /profile?seconds=N on a local port and return the aiohttp runner.
+
+    It's bound to localhost by default, it's meant for operators on the same machine.
+    """
+    from aiohttp import web
+
+    async def profile(request: web.Request) -> web.Response:
+        try:
+            seconds = float(request.query.get("seconds", 30))
+        except ValueError:
+            return web.json_response({"error": "seconds must be a number."}, status=400)
+        if profiler.running:
+            return web.json_response({"error": "A profile is already running."}, status=409)
+        return web.json_response(await profiler.run(seconds))
+
+    application = web.Application()
+    application.router.add_get("/profile", profile)
+    runner = web.AppRunner(application)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def format_summary(summary: dict, limit: int = 10) -> str:
+    """Return a short human readable version of a profile summary."""
+    lines = [f"Profile of {summary['seconds']}s, {summary['busy_samples']} busy samples."]
+    handlers = sorted(
+        summary["handlers"].items(), key=lambda item: item[1]["wall_seconds"], reverse=True
+    )
+    for name, handler_statistics in handlers[:limit]:
+        lines.append(
+            "{0}: {1} calls, wall {2:.3f}s (max {3:.3f}s), cpu ~{4:.3f}s".format(
+                name,
+                handler_statistics["calls"],
+                handler_statistics["wall_seconds"],
+                handler_statistics["max_wall_seconds"],
+                handler_statistics["cpu_seconds"]
+            )
+        )
+    lines.append(f"Slow callbacks: {len(summary['slow_callbacks'])}")
+    return "\n".join(lines)
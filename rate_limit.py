@@ -0,0 +1,73 @@
+"""
+Outbound request budgets of the bots.
+
+Every request telebot sends to the Bot API goes through
+telebot.asyncio_helper._process_request with the bot's token as the first
+argument. install_request_budgets() wraps that function once, and each token
+registered with set_request_budget() then takes a token from its own bucket
+before a request is sent. getUpdates isn't limited, it's long polling.
+"""
+
+import time
+import asyncio
+from typing import Dict
+
+from telebot import asyncio_helper
+
+DEFAULT_REQUESTS_PER_SECOND = 25 # Telegram allows about 30 messages per second per bot.
+DEFAULT_BURST = 25
+UNLIMITED_METHODS = {"getUpdates"}
+
+
+class TokenBucket():
+    """Allow `rate` acquisitions per second on average, with bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        # The lock makes waiters take tokens in arrival order.
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+_budgets: Dict[str, TokenBucket] = {}
+_installed = False
+
+
+def set_request_budget(token: str, rate: float = DEFAULT_REQUESTS_PER_SECOND,
+        capacity: float = DEFAULT_BURST) -> TokenBucket:
+    install_request_budgets()
+    bucket = TokenBucket(rate, capacity)
+    _budgets[token] = bucket
+    return bucket
+
+
+def install_request_budgets() -> None:
+    """Wrap asyncio_helper._process_request, only the first call does something."""
+    global _installed
+    if _installed:
+        return
+    process_request = asyncio_helper._process_request
+
+    async def budgeted_process_request(token, url, *args, **kwargs):
+        bucket = _budgets.get(token)
+        if bucket is not None and url not in UNLIMITED_METHODS:
+            await bucket.acquire()
+        return await process_request(token, url, *args, **kwargs)
+
+    asyncio_helper._process_request = budgeted_process_request
+    _installed = True
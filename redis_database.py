@@ -1,54 +1,309 @@
-import asyncio
+import time
+import codecs
+import zlib
+from contextvars import ContextVar
 
-from typing import Union, Optional
-from redis.asyncio import Redis
+from typing import Union, Optional, AsyncIterator, Tuple, List, NamedTuple
+
+from storage_backends import StorageBackend, create_backend
+
+# Key prefix of the bot handling the current update, set per bot task when several
+# bots share one storage (see multi_bot.py). Empty for a single bot.
+key_namespace: ContextVar[str] = ContextVar("key_namespace", default="")
+
+
+class InboxEntry(NamedTuple):
+    group_chat_id: str
+    private_message_id: str
+    private_message_text: str
 
 
 class RedisDatabase():
+    REDIS_URL = "redis://localhost:6379/0"
     GROUP_CHAT_ID_KEY = "groups:chat_id"
+    PRIVATE_MESSAGE_TTL = 86400 # Delete after 24 hours to reduce memory usage. '86400 = 1 day'
+
+    # Private messages are stored as bytes. Texts longer than COMPRESSION_THRESHOLD
+    # bytes are zlib compressed and prefixed with COMPRESSED_MARKER, shorter ones
+    # are stored as plain UTF-8 because compression doesn't pay off for them.
+    COMPRESSED_MARKER = b"\x00z"
+    COMPRESSION_THRESHOLD = 128
+    # Number of bytes read from redis per GETRANGE call. The first chunk has to hold
+    # the whole COMPRESSED_MARKER, so it can't be smaller than the marker.
+    CHUNK_SIZE = 4096
+
+    # Sorted set of "{group chat id}:{message id}" per recipient, scored by the
+    # message's expiry time. It expires together with the newest message.
+    INBOX_KEY = "inbox:{0}"
+
+    # Sorted set of the group chat ids a user was seen in, scored by when the user
+    # was last seen there. Only the USER_GROUPS_LIMIT most recent groups are kept.
+    USER_GROUPS_KEY = "user_groups:{0}"
+    USER_GROUPS_LIMIT = 200
+    USER_GROUPS_TTL = 30 * 86400 # The index of an inactive user is deleted after 30 days.
+
+    # Progress of group_refresher.py: the last chat_id of the running refresh and
+    # when the last refresh finished. Not namespaced, every bot shares the groups table.
+    GROUP_REFRESH_CURSOR_KEY = "group_refresh:cursor"
+    GROUP_REFRESH_FINISHED_KEY = "group_refresh:finished_at"
     _pool = None
 
     @classmethod
-    async def _connect(cls):
+    async def _connect(cls) -> StorageBackend:
+        # The backend (redis or in-process) is chosen by STORAGE_BACKEND, see storage_backends.py
         if cls._pool is None:
-            cls._pool = await Redis.from_url(
-                url="redis://localhost:6379/0",
-                decode_responses=True
-            )
+            cls._pool = await create_backend(cls.REDIS_URL)
         return cls._pool
 
+    @classmethod
+    async def connect(cls) -> None:
+        """Build the storage backend ahead of the first update."""
+        await cls._connect()
+        return None
+
+    @staticmethod
+    def _key(key: str) -> str:
+        namespace = key_namespace.get()
+        return f"{namespace}:{key}" if namespace else key
+
+    @classmethod
+    def _private_message_key(cls, target_user_id: str, target_group_chat_id: str,
+            private_message_id: str) -> str:
+        return cls._key(f"reciever_user:{target_group_chat_id}:{target_user_id}:{private_message_id}")
+
+    @classmethod
+    def _encode_private_message(cls, private_message_text: str) -> bytes:
+        raw = private_message_text.encode("utf-8")
+        if len(raw) <= cls.COMPRESSION_THRESHOLD:
+            return raw
+        compressed = zlib.compress(raw, level=9)
+        if len(compressed) + len(cls.COMPRESSED_MARKER) >= len(raw):
+            return raw
+        return cls.COMPRESSED_MARKER + compressed
+
+    @classmethod
+    def _decode_private_message(cls, blob: bytes) -> str:
+        if blob.startswith(cls.COMPRESSED_MARKER):
+            blob = zlib.decompress(blob[len(cls.COMPRESSED_MARKER):])
+        return blob.decode("utf-8", errors="replace")
+
     @classmethod
     async def add_chat_id(cls, chat_id: Union[str, int]):
-        connection: Redis = await cls._connect()
+        connection: StorageBackend = await cls._connect()
         if isinstance(chat_id, int):
             chat_id = str(chat_id)
-        await connection.sadd(cls.GROUP_CHAT_ID_KEY, chat_id)
+        await connection.sadd(cls._key(cls.GROUP_CHAT_ID_KEY), chat_id)
         return None
 
     @classmethod
     async def check_chat_id(cls, chat_id: Union[str, int]) -> bool:
-        connection: Redis = await cls._connect()
+        connection: StorageBackend = await cls._connect()
         if isinstance(chat_id, int):
             chat_id = str(chat_id)
-        result = await connection.sismember(cls.GROUP_CHAT_ID_KEY, chat_id)
-        return result
+        result = await connection.sismember(cls._key(cls.GROUP_CHAT_ID_KEY), chat_id)
+        return bool(result)
+
+    @classmethod
+    async def check_chat_ids(cls, chat_ids: List[Union[str, int]]) -> List[bool]:
+        """check_chat_id for several groups with one command."""
+        connection: StorageBackend = await cls._connect()
+        return await connection.smismember(
+            cls._key(cls.GROUP_CHAT_ID_KEY), [str(chat_id) for chat_id in chat_ids]
+        )
 
     @classmethod
     async def store_private_message(cls, target_user_id: str, target_group_chat_id: str,
                 private_message_id: str, private_message_text: str
         ):
-        connection: Redis = await cls._connect()
+        connection: StorageBackend = await cls._connect()
+
+        key = cls._private_message_key(target_user_id, target_group_chat_id, private_message_id)
+        inbox_key = cls._key(cls.INBOX_KEY.format(target_user_id))
 
-        key = f"reciever_user:{target_group_chat_id}:{target_user_id}:{private_message_id}"
-        await connection.set(key, private_message_text, ex=86400) # Delete after 24 hours to reduce memory usage. '86400 = 1 day'
+        # The message and its inbox entry are written together in one MULTI.
+        pipeline = connection.pipeline(transaction=True)
+        pipeline.set(
+            key,
+            cls._encode_private_message(private_message_text),
+            ex=cls.PRIVATE_MESSAGE_TTL
+        )
+        pipeline.zadd(
+            inbox_key,
+            {f"{target_group_chat_id}:{private_message_id}": time.time() + cls.PRIVATE_MESSAGE_TTL}
+        )
+        pipeline.expire(inbox_key, cls.PRIVATE_MESSAGE_TTL)
+        await pipeline.execute()
         return None
 
+    @classmethod
+    async def stream_private_message(cls, target_user_id: str,
+            target_group_chat_id: str, private_message_id: str
+        ) -> AsyncIterator[str]:
+        """Yield the stored private message as decoded text pieces.
+
+        The blob is read with GETRANGE in CHUNK_SIZE pieces and fed through an
+        incremental decompressor and UTF-8 decoder, so the whole blob is never
+        held in memory more than once. Nothing is yielded if the key doesn't exist.
+        """
+        connection: StorageBackend = await cls._connect()
+        key = cls._private_message_key(target_user_id, target_group_chat_id, private_message_id)
+
+        decompressor = None
+        decoder = None
+        offset = 0
+        last_chunk = False
+        while not last_chunk:
+            chunk = await connection.getrange(key, offset, offset + cls.CHUNK_SIZE - 1)
+            if not chunk:
+                break
+            offset += len(chunk)
+            # A short chunk is the end of the blob, most messages need a single GETRANGE.
+            last_chunk = len(chunk) < cls.CHUNK_SIZE
+
+            if decoder is None:
+                # The first chunk decides the encoding of the whole blob.
+                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+                if chunk.startswith(cls.COMPRESSED_MARKER):
+                    decompressor = zlib.decompressobj()
+                    chunk = chunk[len(cls.COMPRESSED_MARKER):]
+
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+
+        if decoder is not None:
+            tail = decompressor.flush() if decompressor is not None else b""
+            text = decoder.decode(tail, final=True)
+            if text:
+                yield text
+
     @classmethod
     async def get_private_message(cls, target_user_id: str,
             target_group_chat_id: str, private_message_id: str
-        ) -> str:
-        connection: Redis = await cls._connect()
-        key = f"reciever_user:{target_group_chat_id}:{target_user_id}:{private_message_id}"
-        private_message = await connection.get(key)
-        return private_message
+        ) -> Optional[str]:
+        pieces = [
+            piece async for piece in cls.stream_private_message(
+                target_user_id, target_group_chat_id, private_message_id
+            )
+        ]
+        if not pieces:
+            return None
+        return "".join(pieces)
+
+    @classmethod
+    async def get_private_message_preview(cls, target_user_id: str,
+            target_group_chat_id: str, private_message_id: str, limit: int
+        ) -> Optional[Tuple[str, bool]]:
+        """Return at most `limit` characters of the private message and whether it was truncated.
+
+        Stops reading from redis as soon as enough text has been decoded.
+        A truncated preview ends with an ellipsis and still fits in `limit`.
+        Returns None if the private message doesn't exist.
+        """
+        preview = ""
+        found = False
+        async for piece in cls.stream_private_message(
+                target_user_id, target_group_chat_id, private_message_id):
+            found = True
+            preview += piece
+            if len(preview) > limit:
+                return preview[:limit - 1] + "…", True
+        return (preview, False) if found else None
+
+    @classmethod
+    async def get_inbox(cls, target_user_id: str, page: int, page_size: int
+        ) -> Tuple[int, List[InboxEntry]]:
+        """Return the number of unexpired private messages of a recipient and one page of them.
+
+        Newest messages come first. Expired entries are pruned, counted and the page
+        is read in one pipeline, then the messages of the page are fetched with one MGET.
+        """
+        connection: StorageBackend = await cls._connect()
+        inbox_key = cls._key(cls.INBOX_KEY.format(target_user_id))
+
+        start = page * page_size
+        pipeline = connection.pipeline()
+        pipeline.zremrangebyscore(inbox_key, float("-inf"), time.time())
+        pipeline.zcard(inbox_key)
+        pipeline.zrevrange(inbox_key, start, start + page_size - 1)
+        _, total, members = await pipeline.execute()
+        members = [member.decode("utf-8") for member in members]
+
+        locations = [member.rpartition(":")[::2] for member in members]
+        blobs = await connection.mget([
+            cls._private_message_key(target_user_id, group_chat_id, private_message_id)
+            for group_chat_id, private_message_id in locations
+        ])
+
+        entries = [
+            InboxEntry(group_chat_id, private_message_id, cls._decode_private_message(blob))
+            for (group_chat_id, private_message_id), blob in zip(locations, blobs)
+            if blob is not None
+        ]
+        return total, entries
+
+    @classmethod
+    async def add_user_group(cls, user_id: Union[str, int], chat_id: Union[str, int]) -> None:
+        """Record that the user was seen in the group now."""
+        connection: StorageBackend = await cls._connect()
+        key = cls._key(cls.USER_GROUPS_KEY.format(user_id))
+        pipeline = connection.pipeline(transaction=True)
+        pipeline.zadd(key, {str(chat_id): time.time()})
+        pipeline.zremrangebyrank(key, 0, -cls.USER_GROUPS_LIMIT - 1)
+        pipeline.expire(key, cls.USER_GROUPS_TTL)
+        await pipeline.execute()
+        return None
 
+    @classmethod
+    async def remove_user_group(cls, user_id: Union[str, int], chat_id: Union[str, int]) -> None:
+        connection: StorageBackend = await cls._connect()
+        await connection.zrem(cls._key(cls.USER_GROUPS_KEY.format(user_id)), str(chat_id))
+        return None
+
+    @classmethod
+    async def has_user_group(cls, user_id: Union[str, int], chat_id: Union[str, int]) -> bool:
+        """Return True if the user was seen in the group, see add_user_group."""
+        connection: StorageBackend = await cls._connect()
+        score = await connection.zscore(cls._key(cls.USER_GROUPS_KEY.format(user_id)), str(chat_id))
+        return score is not None
+
+    @classmethod
+    async def get_user_groups(cls, user_id: Union[str, int]) -> List[str]:
+        """Return the registered groups the user was seen in, most recently seen first."""
+        connection: StorageBackend = await cls._connect()
+        chat_ids = [
+            chat_id.decode("utf-8")
+            for chat_id in await connection.zrevrange(cls._key(cls.USER_GROUPS_KEY.format(user_id)), 0, -1)
+        ]
+        registered = await connection.smismember(cls._key(cls.GROUP_CHAT_ID_KEY), chat_ids)
+        return [chat_id for chat_id, is_registered in zip(chat_ids, registered) if is_registered]
+
+    @classmethod
+    async def get_group_refresh_progress(cls) -> Tuple[Optional[int], Optional[float]]:
+        """Return the chat_id the running group refresh got to and when the last one finished."""
+        connection: StorageBackend = await cls._connect()
+        cursor, finished_at = await connection.mget(
+            [cls.GROUP_REFRESH_CURSOR_KEY, cls.GROUP_REFRESH_FINISHED_KEY]
+        )
+        return (
+            int(cursor) if cursor is not None else None,
+            float(finished_at) if finished_at is not None else None
+        )
+
+    @classmethod
+    async def set_group_refresh_cursor(cls, chat_id: int) -> None:
+        connection: StorageBackend = await cls._connect()
+        await connection.set(cls.GROUP_REFRESH_CURSOR_KEY, str(chat_id).encode("utf-8"))
+        return None
+
+    @classmethod
+    async def finish_group_refresh(cls) -> None:
+        connection: StorageBackend = await cls._connect()
+        pipeline = connection.pipeline(transaction=True)
+        pipeline.delete(cls.GROUP_REFRESH_CURSOR_KEY)
+        pipeline.set(cls.GROUP_REFRESH_FINISHED_KEY, str(time.time()).encode("utf-8"))
+        await pipeline.execute()
+        return None
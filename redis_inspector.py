@@ -0,0 +1,196 @@
+"""
+Report the population and memory footprint of the bot's redis keys as JSON.
+
+Keys are walked with cursor based SCAN (never KEYS, which blocks redis), and
+for every SCAN batch the TTL and MEMORY USAGE of its keys are requested in one
+pipeline. With --sample-rate below 1, MEMORY USAGE is only requested for that
+fraction of the keys and the memory totals are extrapolated.
+
+Usage:
+    python3 redis_inspector.py
+    python3 redis_inspector.py --sample-rate 0.1 --state-pattern "telebot*"
+    python3 redis_inspector.py --namespace brand_a   # one bot of multi_bot.py
+"""
+
+import sys
+import json
+import random
+import asyncio
+import argparse
+from typing import Dict, List
+
+from redis.asyncio import Redis
+
+from redis_database import RedisDatabase as rd
+
+PRIVATE_MESSAGE_PATTERN = "reciever_user:*"
+SCAN_COUNT = 1000 # Hint for the number of keys redis returns per SCAN call.
+
+# (upper bound in seconds, bucket name), checked in order.
+TTL_BUCKETS = (
+    (3600, "<1h"),
+    (6 * 3600, "1h-6h"),
+    (24 * 3600, "6h-24h"),
+)
+
+
+def get_ttl_bucket(ttl: int) -> str:
+    if ttl == -1:
+        return "no_expiry"
+    if ttl == -2:
+        return "expired" # Deleted between SCAN and TTL.
+    for upper_bound, name in TTL_BUCKETS:
+        if ttl < upper_bound:
+            return name
+    return ">24h"
+
+
+class KeyStatistics():
+    """Population, memory and TTL distribution of a set of keys."""
+
+    def __init__(self):
+        self.keys = 0
+        self.sampled_keys = 0
+        self.sampled_memory = 0
+        self.ttl_buckets: Dict[str, int] = {}
+
+    def add(self, ttl: int, memory: int = None) -> None:
+        self.keys += 1
+        bucket = get_ttl_bucket(ttl)
+        self.ttl_buckets[bucket] = self.ttl_buckets.get(bucket, 0) + 1
+        if memory is not None:
+            self.sampled_keys += 1
+            self.sampled_memory += memory
+
+    def to_dict(self) -> dict:
+        estimated_memory = 0
+        if self.sampled_keys:
+            estimated_memory = round(self.sampled_memory / self.sampled_keys * self.keys)
+        return {
+            "keys": self.keys,
+            "sampled_keys": self.sampled_keys,
+            "memory_bytes": estimated_memory,
+            "ttl_buckets": self.ttl_buckets,
+        }
+
+
+async def scan_keys(connection: Redis, pattern: str, sample_rate: float,
+        memory_samples: int, on_key) -> None:
+    """SCAN all keys matching `pattern` and call on_key(key, ttl, memory) for each.
+
+    memory is None for keys which weren't sampled.
+    """
+    cursor = 0
+    while True:
+        cursor, keys = await connection.scan(cursor=cursor, match=pattern, count=SCAN_COUNT)
+        if keys:
+            sampled = [random.random() < sample_rate for _ in keys]
+            pipeline = connection.pipeline(transaction=False)
+            for key, is_sampled in zip(keys, sampled):
+                pipeline.ttl(key)
+                if is_sampled:
+                    pipeline.memory_usage(key, samples=memory_samples)
+            results = iter(await pipeline.execute())
+
+            for key, is_sampled in zip(keys, sampled):
+                ttl = next(results)
+                memory = next(results) if is_sampled else None
+                on_key(key.decode("utf-8"), ttl, memory)
+
+        if cursor == 0:
+            break
+
+
+def get_key_prefix(namespace: str) -> str:
+    """Return the prefix of a bot's keys, see redis_database.key_namespace."""
+    return f"{namespace}:" if namespace else ""
+
+
+async def inspect(redis_url: str, state_patterns: List[str], sample_rate: float,
+        memory_samples: int, namespace: str = "") -> dict:
+    connection: Redis = await Redis.from_url(url=redis_url, decode_responses=False)
+    prefix = get_key_prefix(namespace)
+    group_chat_id_key = prefix + rd.GROUP_CHAT_ID_KEY
+
+    private_messages = KeyStatistics()
+    private_messages_per_group: Dict[str, KeyStatistics] = {}
+
+    def on_private_message(key: str, ttl: int, memory: int) -> None:
+        private_messages.add(ttl, memory)
+        # [namespace:]reciever_user:{group chat id}:{user id}:{message id}
+        group_chat_id = key[len(prefix):].split(":")[1]
+        private_messages_per_group.setdefault(group_chat_id, KeyStatistics()).add(ttl, memory)
+
+    await scan_keys(connection, prefix + PRIVATE_MESSAGE_PATTERN, sample_rate,
+        memory_samples, on_private_message)
+
+    states = KeyStatistics()
+    for pattern in state_patterns:
+        await scan_keys(connection, pattern, sample_rate, memory_samples,
+            lambda key, ttl, memory: states.add(ttl, memory))
+
+    pipeline = connection.pipeline(transaction=False)
+    pipeline.scard(group_chat_id_key)
+    pipeline.memory_usage(group_chat_id_key, samples=memory_samples)
+    pipeline.info("memory")
+    group_members, group_memory, memory_info = await pipeline.execute()
+
+    await connection.aclose()
+
+    groups = {
+        group_chat_id: statistics.to_dict()
+        for group_chat_id, statistics in sorted(
+            private_messages_per_group.items(),
+            key=lambda item: item[1].sampled_memory,
+            reverse=True
+        )
+    }
+    return {
+        "namespace": namespace,
+        "redis_used_memory_bytes": memory_info.get("used_memory"),
+        "sample_rate": sample_rate,
+        "private_messages": dict(private_messages.to_dict(), groups=groups),
+        "fsm_states": dict(states.to_dict(), patterns=state_patterns),
+        "groups_chat_id": {
+            "members": group_members,
+            "memory_bytes": group_memory or 0,
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report population and memory usage of the bot's redis keys as JSON."
+    )
+    parser.add_argument("--redis-url", default=rd.REDIS_URL)
+    parser.add_argument(
+        "--namespace", default="",
+        help="Name of the bot in BOT_TOKENS whose keys are inspected (default: a single bot)."
+    )
+    parser.add_argument(
+        "--state-pattern", action="append", dest="state_patterns",
+        help="SCAN pattern of FSM state keys, can be repeated (default: [namespace:]telebot*)."
+    )
+    parser.add_argument(
+        "--sample-rate", type=float, default=1.0,
+        help="Fraction of keys whose MEMORY USAGE is requested (default: 1.0)."
+    )
+    parser.add_argument(
+        "--memory-samples", type=int, default=5,
+        help="SAMPLES argument of MEMORY USAGE for nested values like FSM hashes."
+    )
+    parser.add_argument("--indent", type=int, default=2)
+    args = parser.parse_args()
+
+    if not 0 < args.sample_rate <= 1:
+        parser.error("--sample-rate must be in (0, 1].")
+
+    report = asyncio.run(inspect(
+        redis_url=args.redis_url,
+        state_patterns=args.state_patterns or [get_key_prefix(args.namespace) + "telebot*"],
+        sample_rate=args.sample_rate,
+        memory_samples=args.memory_samples,
+        namespace=args.namespace
+    ))
+    json.dump(report, sys.stdout, indent=args.indent)
+    sys.stdout.write("\n")
@@ -1,11 +1,13 @@
 import os
-from typing import Optional
+from typing import Optional, List, Dict, Any
 
 from telebot.async_telebot import logger
-from sqlalchemy import create_engine, URL, INTEGER
+from sqlalchemy import create_engine, inspect, update, Engine, URL, INTEGER
 from sqlalchemy.orm import DeclarativeBase, mapped_column, Mapped, sessionmaker
 from sqlalchemy.orm.session import Session as Se
 
+from circuit_breaker import sql_breaker
+
 class Base(DeclarativeBase):
     pass
 
@@ -26,16 +28,71 @@ class GroupInformation(Base):
     json_photos: Mapped[Optional[str]]
 
 DATABASE_NAME = "bot_database.db"
+ALEMBIC_CONFIG_FILE = "alembic.ini"
 url = URL.create(drivername="sqlite", database=DATABASE_NAME)
-engine = create_engine(url)
-Session = sessionmaker(bind=engine)
+# Seconds a query waits for a locked database before it fails, sqlite's default is 5.
+SQLITE_BUSY_TIMEOUT = 1
+# Columns which group_refresher.py keeps up to date.
+METADATA_COLUMNS = ("title", "username", "description", "bio", "json_photos")
+
+# The engine is created by init_engine() at startup instead of at import.
+engine = None
+Session = sessionmaker()
+
+
+def init_engine() -> Engine:
+    """Create the engine and bind Session to it, only the first call creates it."""
+    global engine
+    if engine is None:
+        engine = create_engine(url, connect_args={"timeout": SQLITE_BUSY_TIMEOUT})
+        Session.configure(bind=engine)
+    return engine
+
+
+def _get_session() -> Se:
+    init_engine()
+    return Session()
+
+
+def check_schema_revision() -> str:
+    """Check once at startup that the database schema is at the alembic head revision.
+
+    A new database gets its tables from Base and is stamped with the head revision.
+    Raises RuntimeError if an existing database isn't up to date.
+    """
+    # alembic is only needed here, so it isn't imported at module level.
+    # alembic.command isn't used because env.py reconfigures the logging of the bot.
+    from alembic.config import Config
+    from alembic.script import ScriptDirectory
+    from alembic.runtime.migration import MigrationContext
+
+    script = ScriptDirectory.from_config(Config(ALEMBIC_CONFIG_FILE))
+    head_revision = script.get_current_head()
+
+    with init_engine().begin() as connection:
+        context = MigrationContext.configure(connection)
+        current_revision = context.get_current_revision()
+
+        if current_revision is None and not inspect(connection).has_table(GroupInformation.__tablename__):
+            Base.metadata.create_all(connection)
+            context.stamp(script, "head")
+            logger.info(f"New database {DATABASE_NAME} created at revision {head_revision}.")
+            return head_revision
+
+    if current_revision != head_revision:
+        raise RuntimeError(
+            f"Database schema revision is {current_revision}, expected {head_revision}. "
+            "Run 'alembic upgrade head'."
+        )
+    logger.info(f"Database schema is at revision {current_revision}.")
+    return current_revision
 
 
 def create_database_and_table() -> None:
     """Create a database and the tables from Base class."""
     try:
         database_exists = os.path.exists(DATABASE_NAME)
-        Base.metadata.create_all(engine)
+        Base.metadata.create_all(init_engine())
 
         if database_exists:
             logger.info(f"Database {DATABASE_NAME} already exists.")
@@ -47,41 +104,93 @@ def create_database_and_table() -> None:
         logger.error("An error occured.", exc_info=True)
 
 
+@sql_breaker.protect_sync
 def store_group_info(chat_id: int, username: str, chat_type: str,
         title: str, description: str, is_forum: bool,
         bio: str, date_membership: str, json_photos: str) -> None:
-    try:
-        session: Se
-        with Session() as session:
-            row = GroupInformation(
-                chat_id=chat_id,
-                username=username,
-                chat_type=chat_type,
-                title=title,
-                description=description,
-                is_forum=is_forum,
-                bio=bio,
-                date_membership=date_membership,
-                json_photos=json_photos,
-            )
-            session.add(row)
-            session.commit()
-    except Exception as ex:
-        logger.error("An error occured.", exc_info=True)
-
+    """Insert the group, or overwrite its row when the bot joins it again.
 
+    Errors are raised to the caller, so the circuit breaker sees a failing database
+    and the group isn't registered in redis without its row.
+    """
+    session: Se
+    with _get_session() as session:
+        row = GroupInformation(
+            chat_id=chat_id,
+            username=username,
+            chat_type=chat_type,
+            title=title,
+            description=description,
+            is_forum=is_forum,
+            bio=bio,
+            date_membership=date_membership,
+            json_photos=json_photos,
+        )
+        session.merge(row)
+        session.commit()
+    return None
+
+
+@sql_breaker.protect_sync
 def get_group_title(group_chat_id: str) -> str:
     session: Se
-    with Session() as session:
+    with _get_session() as session:
         group_info = session.query(GroupInformation)
         group_title = group_info.filter(GroupInformation.chat_id == group_chat_id).first().title
     return group_title
 
 
+@sql_breaker.protect_sync
 def get_group_username(group_chat_id: str) -> str:
     session: Se
-    with Session() as session:
+    with _get_session() as session:
         group_info = session.query(GroupInformation)
         group_username = group_info.filter(GroupInformation.chat_id == group_chat_id).first().username
     return group_username
 
+
+
+@sql_breaker.protect_sync
+def get_group_titles(group_chat_ids: List[int]) -> Dict[int, str]:
+    """Return {chat_id: title} of the given groups with a single query."""
+    if not group_chat_ids:
+        return {}
+    session: Se
+    with _get_session() as session:
+        rows = session.query(GroupInformation.chat_id, GroupInformation.title).filter(
+            GroupInformation.chat_id.in_(group_chat_ids)
+        )
+        group_titles = {chat_id: title for chat_id, title in rows}
+    return group_titles
+
+
+@sql_breaker.protect_sync
+def get_group_metadata_page(after_chat_id: Optional[int], limit: int) -> List[Dict[str, Any]]:
+    """Return chat_id and METADATA_COLUMNS of up to `limit` groups, ordered by chat_id.
+
+    The page starts after `after_chat_id` (from the first group if it's None), so
+    every page is a primary key range read however far the caller has got.
+    """
+    columns = [GroupInformation.chat_id] + [getattr(GroupInformation, column) for column in METADATA_COLUMNS]
+    session: Se
+    with _get_session() as session:
+        query = session.query(*columns).order_by(GroupInformation.chat_id)
+        if after_chat_id is not None:
+            query = query.filter(GroupInformation.chat_id > after_chat_id)
+        rows = [row._asdict() for row in query.limit(limit)]
+    return rows
+
+
+@sql_breaker.protect_sync
+def update_group_metadata(changes: Dict[int, Dict[str, Optional[str]]]) -> None:
+    """Write {chat_id: {column: value}} in a single transaction, only the given columns are updated."""
+    if not changes:
+        return None
+    session: Se
+    with _get_session() as session:
+        for chat_id, columns in changes.items():
+            session.execute(
+                update(GroupInformation).where(GroupInformation.chat_id == chat_id).values(**columns)
+            )
+        session.commit()
+    return None
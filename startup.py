@@ -0,0 +1,34 @@
+"""
+Measure the bot's startup path.
+
+main.py marks the end of each startup phase (the imports of telebot, sqlalchemy,
+the storage modules and the rest, bot creation, storage connection, schema
+check, ...) and the breakdown is logged once polling starts.
+For a per-module import breakdown run: python3 -X importtime main.py
+"""
+
+import time
+from typing import List, Tuple
+
+
+class StartupTimer():
+    def __init__(self):
+        self._started = time.perf_counter()
+        self._last = self._started
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, phase: str) -> None:
+        """Record the time spent since the previous mark as `phase`."""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    @property
+    def total(self) -> float:
+        return self._last - self._started
+
+    def report(self) -> str:
+        lines = [f"Startup took {self.total * 1000:.1f} ms:"]
+        for phase, seconds in self.phases:
+            lines.append(f"  {phase}: {seconds * 1000:.1f} ms")
+        return "\n".join(lines)
@@ -0,0 +1,466 @@
+"""
+Storage backends of RedisDatabase and the FSM state storage.
+
+RedisDatabase only uses the small set of redis commands declared by
+StorageBackend, so it can run either on redis (RedisBackend) or entirely in
+process (MemoryBackend), for single node deployments, tests and benchmarks.
+
+The backend is chosen with the STORAGE_BACKEND environment variable:
+    redis  (default) - redis at RedisDatabase.REDIS_URL, FSM state in StateRedisStorage
+    memory           - MemoryBackend, FSM state in telebot's StateMemoryStorage
+
+The FSM state storage isn't built on StorageBackend, it's the telebot storage
+matching the backend, so in memory mode FSM state isn't kept in MemoryBackend.
+
+Every redis command, of RedisBackend and of the FSM state storage, goes through
+circuit_breaker.redis_breaker, so a stalled redis fails fast instead of holding
+every update for the socket timeout.
+"""
+
+import os
+import time
+import heapq
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from circuit_breaker import redis_breaker
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "redis")
+
+Member = Union[str, int]
+
+_connection_pools = {}
+
+
+def get_connection_pool(redis_url: str):
+    """Return the redis connection pool of `redis_url`, shared by every bot in the process."""
+    if redis_url not in _connection_pools:
+        from redis.asyncio import ConnectionPool
+        _connection_pools[redis_url] = ConnectionPool.from_url(redis_url, decode_responses=False)
+    return _connection_pools[redis_url]
+
+
+def _normalize_range(start: int, end: int, length: int) -> Tuple[int, int]:
+    """Turn a redis range (inclusive, negative from the end) into non-negative indices.
+
+    An empty range is returned as (0, -1).
+    """
+    if start < 0:
+        start = max(start + length, 0)
+    if end < 0:
+        end += length
+    if end < start:
+        return 0, -1
+    return start, end
+
+
+Command = Tuple[str, tuple, dict]
+
+
+class StoragePipeline():
+    """Commands queued under their StorageBackend names and sent together by execute().
+
+    Only the results of reading commands are specified, write commands may
+    return anything (redis returns the number of changed elements).
+    """
+
+    def __init__(self, backend: "StorageBackend", transaction: bool):
+        self._backend = backend
+        self._transaction = transaction
+        self._commands: List[Command] = []
+
+    def _queue(self, name: str, *args, **kwargs) -> "StoragePipeline":
+        self._commands.append((name, args, kwargs))
+        return self
+
+    def set(self, key: str, value: bytes, ex: Optional[int] = None) -> "StoragePipeline":
+        return self._queue("set", key, value, ex=ex)
+
+    def delete(self, key: str) -> "StoragePipeline":
+        return self._queue("delete", key)
+
+    def expire(self, key: str, seconds: int) -> "StoragePipeline":
+        return self._queue("expire", key, seconds)
+
+    def zadd(self, key: str, mapping: Dict[str, float]) -> "StoragePipeline":
+        return self._queue("zadd", key, mapping)
+
+    def zremrangebyscore(self, key: str, minimum: float, maximum: float) -> "StoragePipeline":
+        return self._queue("zremrangebyscore", key, minimum, maximum)
+
+    def zremrangebyrank(self, key: str, start: int, end: int) -> "StoragePipeline":
+        return self._queue("zremrangebyrank", key, start, end)
+
+    def zcard(self, key: str) -> "StoragePipeline":
+        return self._queue("zcard", key)
+
+    def zrevrange(self, key: str, start: int, end: int) -> "StoragePipeline":
+        return self._queue("zrevrange", key, start, end)
+
+    async def execute(self) -> list:
+        """Send the queued commands in one round trip and return their results in order."""
+        return await self._backend.execute_pipeline(self._commands, self._transaction)
+
+
+class StorageBackend(ABC):
+    """The redis commands RedisDatabase needs, with redis semantics."""
+
+    def pipeline(self, transaction: bool = False) -> StoragePipeline:
+        """Queue commands to send at once, as a MULTI/EXEC transaction if `transaction` is True."""
+        return StoragePipeline(self, transaction)
+
+    @abstractmethod
+    async def execute_pipeline(self, commands: List[Command], transaction: bool) -> list: ...
+
+    @abstractmethod
+    async def sadd(self, key: str, member: Member) -> None: ...
+
+    @abstractmethod
+    async def sismember(self, key: str, member: Member) -> bool: ...
+
+    @abstractmethod
+    async def smismember(self, key: str, members: List[Member]) -> List[bool]: ...
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ex: Optional[int] = None) -> None: ...
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[bytes]: ...
+
+    @abstractmethod
+    async def getrange(self, key: str, start: int, end: int) -> bytes:
+        """Return the bytes from start to end, both inclusive, b"" if the key doesn't exist."""
+
+    @abstractmethod
+    async def delete(self, key: str) -> None: ...
+
+    @abstractmethod
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]: ...
+
+    @abstractmethod
+    async def expire(self, key: str, seconds: int) -> None: ...
+
+    @abstractmethod
+    async def zadd(self, key: str, mapping: Dict[str, float]) -> None: ...
+
+    @abstractmethod
+    async def zrem(self, key: str, member: str) -> None: ...
+
+    @abstractmethod
+    async def zremrangebyscore(self, key: str, minimum: float, maximum: float) -> None: ...
+
+    @abstractmethod
+    async def zremrangebyrank(self, key: str, start: int, end: int) -> None:
+        """Remove members from rank start to end (inclusive), lowest score first."""
+
+    @abstractmethod
+    async def zcard(self, key: str) -> int: ...
+
+    @abstractmethod
+    async def zscore(self, key: str, member: str) -> Optional[float]: ...
+
+    @abstractmethod
+    async def zrevrange(self, key: str, start: int, end: int) -> List[bytes]:
+        """Return members from rank start to end (inclusive), highest score first."""
+
+
+class RedisBackend(StorageBackend):
+    def __init__(self, connection):
+        self.connection = connection
+
+    @classmethod
+    async def from_url(cls, url: str) -> "RedisBackend":
+        from redis.asyncio import Redis
+        return cls(Redis(connection_pool=get_connection_pool(url)))
+
+    @redis_breaker.protect
+    async def execute_pipeline(self, commands: List[Command], transaction: bool) -> list:
+        # StoragePipeline's command names are the same as redis-py's.
+        async with self.connection.pipeline(transaction=transaction) as pipeline:
+            for name, args, kwargs in commands:
+                getattr(pipeline, name)(*args, **kwargs)
+            return await pipeline.execute()
+
+    @redis_breaker.protect
+    async def sadd(self, key: str, member: Member) -> None:
+        await self.connection.sadd(key, member)
+
+    @redis_breaker.protect
+    async def sismember(self, key: str, member: Member) -> bool:
+        return bool(await self.connection.sismember(key, member))
+
+    @redis_breaker.protect
+    async def smismember(self, key: str, members: List[Member]) -> List[bool]:
+        if not members:
+            return []
+        return [bool(result) for result in await self.connection.smismember(key, members)]
+
+    @redis_breaker.protect
+    async def set(self, key: str, value: bytes, ex: Optional[int] = None) -> None:
+        await self.connection.set(key, value, ex=ex)
+
+    @redis_breaker.protect
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.connection.get(key)
+
+    @redis_breaker.protect
+    async def getrange(self, key: str, start: int, end: int) -> bytes:
+        return await self.connection.getrange(key, start, end)
+
+    @redis_breaker.protect
+    async def delete(self, key: str) -> None:
+        await self.connection.delete(key)
+
+    @redis_breaker.protect
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        if not keys:
+            return []
+        return await self.connection.mget(keys)
+
+    @redis_breaker.protect
+    async def expire(self, key: str, seconds: int) -> None:
+        await self.connection.expire(key, seconds)
+
+    @redis_breaker.protect
+    async def zadd(self, key: str, mapping: Dict[str, float]) -> None:
+        await self.connection.zadd(key, mapping)
+
+    @redis_breaker.protect
+    async def zrem(self, key: str, member: str) -> None:
+        await self.connection.zrem(key, member)
+
+    @redis_breaker.protect
+    async def zremrangebyscore(self, key: str, minimum: float, maximum: float) -> None:
+        await self.connection.zremrangebyscore(key, minimum, maximum)
+
+    @redis_breaker.protect
+    async def zremrangebyrank(self, key: str, start: int, end: int) -> None:
+        await self.connection.zremrangebyrank(key, start, end)
+
+    @redis_breaker.protect
+    async def zcard(self, key: str) -> int:
+        return await self.connection.zcard(key)
+
+    @redis_breaker.protect
+    async def zscore(self, key: str, member: str) -> Optional[float]:
+        return await self.connection.zscore(key, member)
+
+    @redis_breaker.protect
+    async def zrevrange(self, key: str, start: int, end: int) -> List[bytes]:
+        return await self.connection.zrevrange(key, start, end)
+
+
+class MemoryBackend(StorageBackend):
+    """In-process storage with redis-like TTL expiry.
+
+    Deadlines are kept in one heap. Expired keys are removed lazily before every
+    command and by a single loop timer scheduled for the earliest deadline, so
+    there is no task or timer per key.
+
+    A key has at most one live heap entry. Moving its deadline later (the usual
+    EXPIRE refresh) doesn't push a new one: when the old entry comes up it's pushed
+    again with the key's current deadline, so the heap grows with the number of
+    keys, not with the number of writes.
+    """
+
+    def __init__(self):
+        # bytes for strings, set for sets and {member: score} dict for sorted sets.
+        self._data: Dict[str, Union[bytes, Set[str], Dict[str, float]]] = {}
+        self._deadlines: Dict[str, float] = {}
+        self._scheduled: Dict[str, float] = {} # Deadline of each key's live heap entry.
+        self._heap: List[Tuple[float, str]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_deadline: Optional[float] = None
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            # Entries replaced by an earlier deadline are stale.
+            if self._scheduled.get(key) != deadline:
+                continue
+            current = self._deadlines.get(key)
+            if current is None:
+                del self._scheduled[key] # The key was deleted or persisted.
+            elif current <= now:
+                del self._scheduled[key]
+                del self._deadlines[key]
+                del self._data[key]
+            else:
+                self._scheduled[key] = current
+                heapq.heappush(heap, (current, key))
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._timer_deadline = None
+        self._expire()
+        self._schedule_timer()
+
+    def _schedule_timer(self) -> None:
+        if not self._heap:
+            return
+        deadline = self._heap[0][0]
+        if self._timer_deadline is not None and self._timer_deadline <= deadline:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return # Without a running loop keys still expire lazily.
+        if self._timer is not None:
+            self._timer.cancel()
+        # loop.time() is time.monotonic() on the default event loops.
+        self._timer = loop.call_at(deadline, self._on_timer)
+        self._timer_deadline = deadline
+
+    def _set_deadline(self, key: str, ex: Optional[int]) -> None:
+        if ex is None:
+            self._deadlines.pop(key, None)
+            return
+        deadline = time.monotonic() + ex
+        self._deadlines[key] = deadline
+        scheduled = self._scheduled.get(key)
+        if scheduled is not None and scheduled <= deadline:
+            return # The key's entry comes up first and is pushed again then.
+        self._scheduled[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        self._schedule_timer()
+
+    async def execute_pipeline(self, commands: List[Command], transaction: bool) -> list:
+        # The commands never wait for anything, so they always run as one atomic step.
+        return [await getattr(self, name)(*args, **kwargs) for name, args, kwargs in commands]
+
+    async def sadd(self, key: str, member: Member) -> None:
+        self._expire()
+        self._data.setdefault(key, set()).add(str(member))
+
+    async def sismember(self, key: str, member: Member) -> bool:
+        self._expire()
+        return str(member) in self._data.get(key, ())
+
+    async def smismember(self, key: str, members: List[Member]) -> List[bool]:
+        self._expire()
+        stored = self._data.get(key, ())
+        return [str(member) in stored for member in members]
+
+    async def set(self, key: str, value: bytes, ex: Optional[int] = None) -> None:
+        self._expire()
+        self._data[key] = value
+        self._set_deadline(key, ex)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        self._expire()
+        return self._data.get(key)
+
+    async def getrange(self, key: str, start: int, end: int) -> bytes:
+        self._expire()
+        value = self._data.get(key, b"")
+        start, end = _normalize_range(start, end, len(value))
+        return value[start:end + 1]
+
+    async def delete(self, key: str) -> None:
+        self._expire()
+        self._data.pop(key, None)
+        self._deadlines.pop(key, None)
+
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        self._expire()
+        return [self._data.get(key) for key in keys]
+
+    async def expire(self, key: str, seconds: int) -> None:
+        self._expire()
+        if key in self._data:
+            self._set_deadline(key, seconds)
+
+    def _delete_if_empty(self, key: str) -> None:
+        # Like redis, an empty sorted set doesn't exist.
+        if not self._data.get(key, True):
+            self._data.pop(key, None)
+            self._deadlines.pop(key, None)
+
+    async def zadd(self, key: str, mapping: Dict[str, float]) -> None:
+        self._expire()
+        self._data.setdefault(key, {}).update(
+            (str(member), float(score)) for member, score in mapping.items()
+        )
+
+    async def zrem(self, key: str, member: str) -> None:
+        self._expire()
+        self._data.get(key, {}).pop(str(member), None)
+        self._delete_if_empty(key)
+
+    async def zremrangebyscore(self, key: str, minimum: float, maximum: float) -> None:
+        self._expire()
+        members = self._data.get(key, {})
+        for member, score in list(members.items()):
+            if minimum <= score <= maximum:
+                del members[member]
+        self._delete_if_empty(key)
+
+    async def zremrangebyrank(self, key: str, start: int, end: int) -> None:
+        self._expire()
+        members = self._data.get(key, {})
+        ranked = sorted(members.items(), key=lambda item: (item[1], item[0]))
+        start, end = _normalize_range(start, end, len(ranked))
+        for member, _ in ranked[start:end + 1]:
+            del members[member]
+        self._delete_if_empty(key)
+
+    async def zcard(self, key: str) -> int:
+        self._expire()
+        return len(self._data.get(key, {}))
+
+    async def zscore(self, key: str, member: str) -> Optional[float]:
+        self._expire()
+        return self._data.get(key, {}).get(str(member))
+
+    async def zrevrange(self, key: str, start: int, end: int) -> List[bytes]:
+        self._expire()
+        members = sorted(
+            self._data.get(key, {}).items(), key=lambda item: (item[1], item[0]), reverse=True
+        )
+        start, end = _normalize_range(start, end, len(members))
+        return [member.encode("utf-8") for member, _ in members[start:end + 1]]
+
+
+async def create_backend(redis_url: str) -> StorageBackend:
+    if STORAGE_BACKEND == "memory":
+        return MemoryBackend()
+    if STORAGE_BACKEND == "redis":
+        return await RedisBackend.from_url(redis_url)
+    raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}.")
+
+
+def _protect_client(client) -> None:
+    """Send every command and pipeline of a redis client through redis_breaker.
+
+    The breaker wraps the client rather than StateRedisStorage's methods, which
+    first wait for the storage's lock (shared by every chat of the bot): only the
+    round trip to redis counts towards the slow call duration and the timeout.
+    """
+    client.execute_command = redis_breaker.protect(client.execute_command)
+    create_pipeline = client.pipeline
+
+    def pipeline(*args, **kwargs):
+        pipe = create_pipeline(*args, **kwargs)
+        pipe.execute = redis_breaker.protect(pipe.execute)
+        return pipe
+
+    client.pipeline = pipeline
+
+
+def create_state_storage(redis_url: str, prefix: str = "telebot"):
+    """Return the telebot FSM state storage matching STORAGE_BACKEND.
+
+    State keys start with `prefix`, bots sharing a redis need different prefixes.
+    """
+    if STORAGE_BACKEND == "memory":
+        from telebot.asyncio_storage import StateMemoryStorage
+        return StateMemoryStorage()
+    if STORAGE_BACKEND == "redis":
+        from telebot.asyncio_storage import StateRedisStorage
+        storage = StateRedisStorage(prefix=prefix, connection_pool=get_connection_pool(redis_url))
+        _protect_client(storage.redis)
+        return storage
+    raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}.")
@@ -0,0 +1,296 @@
+"""
+Run the bot with several worker processes sharing one update stream.
+
+The supervisor is the only process that calls getUpdates. Every raw update is
+pushed to a redis list chosen by the update's chat id, so all updates of a chat,
+and therefore every access to its FSM state, are handled by the same worker.
+
+Workers are started with the spawn method. Each one imports main.py by itself,
+so the bot, the redis pool and the SQLAlchemy engine are built inside the worker
+and never shared with the supervisor or another worker.
+
+A worker moves the updates it takes (BLMOVE) to its own processing list and
+removes them only once they're handled. A worker which crashed or was killed
+leaves them there, and its replacement queues them again before taking new
+ones, so they're handled again instead of lost. On SIGTERM a worker stops
+taking updates and finishes the running ones before exiting.
+
+Usage:
+    python3 supervisor.py --workers 4
+"""
+
+import os
+import json
+import time
+import signal
+import asyncio
+import argparse
+import multiprocessing
+from typing import List
+
+from redis.asyncio import Redis
+from telebot import asyncio_helper
+from telebot.async_telebot import logger
+
+import storage_backends
+from redis_database import RedisDatabase as rd
+
+# Same as main.ALLOWED_UPDATES, main.py isn't imported in the supervisor process.
+ALLOWED_UPDATES = ["message", "callback_query", "my_chat_member", "chat_member"]
+
+UPDATE_QUEUE_KEY = "updates:queue:{0}" # One redis list per worker.
+PROCESSING_QUEUE_KEY = "updates:processing:{0}" # Updates a worker took but hasn't handled yet.
+# Error log of each worker, a rotating file can only be written by one process.
+WORKER_ERROR_LOG_FILE = "error.{0}.log"
+GET_UPDATES_LIMIT = 100
+GET_UPDATES_TIMEOUT = 20 # Seconds of telegram long polling.
+WORKER_BATCH_SIZE = 100 # Maximum number of updates a worker takes from its queue at once.
+WORKER_CHECK_INTERVAL = 1 # Seconds between checks for dead workers.
+WORKER_POLL_TIMEOUT = 1 # Seconds a worker waits for updates before checking if it's stopping.
+WORKER_DRAIN_TIMEOUT = 30 # Seconds a stopping worker waits for its running batches.
+# Batches a worker processes at the same time. Once they're all running the worker
+# stops taking updates, which then wait in its redis list.
+WORKER_MAX_RUNNING_BATCHES = 32
+
+
+def get_partition_chat_id(update: dict) -> int:
+    """Return the chat id an update belongs to.
+
+    Messages and member updates carry a chat, callback queries carry the chat of
+    their message. Updates without any chat (inline queries, polls, ...) fall back
+    to the sender's id and finally to the update id.
+    """
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = value.get("from")
+        if user:
+            return user["id"]
+    return update["update_id"]
+
+
+async def requeue_unfinished_updates(connection: Redis, worker_index: int) -> int:
+    """Put the updates left in a worker's processing list back at the front of its queue.
+
+    Returns the number of queued updates, they keep their order.
+    """
+    queue = UPDATE_QUEUE_KEY.format(worker_index)
+    processing = PROCESSING_QUEUE_KEY.format(worker_index)
+    requeued = 0
+    while await connection.lmove(processing, queue, "RIGHT", "LEFT") is not None:
+        requeued += 1
+    return requeued
+
+
+async def take_updates(connection: Redis, worker_index: int) -> List[bytes]:
+    """Move up to WORKER_BATCH_SIZE updates from a worker's queue to its processing list.
+
+    Waits at most WORKER_POLL_TIMEOUT seconds for the first one, returns [] if none came.
+    """
+    queue = UPDATE_QUEUE_KEY.format(worker_index)
+    processing = PROCESSING_QUEUE_KEY.format(worker_index)
+    raw_update = await connection.blmove(queue, processing, WORKER_POLL_TIMEOUT, "LEFT", "RIGHT")
+    if raw_update is None:
+        return []
+
+    pipeline = connection.pipeline(transaction=False)
+    for _ in range(WORKER_BATCH_SIZE - 1):
+        pipeline.lmove(queue, processing, "LEFT", "RIGHT")
+    rest = await pipeline.execute()
+    return [raw_update] + [raw_update for raw_update in rest if raw_update is not None]
+
+
+async def finish_updates(connection: Redis, worker_index: int, raw_updates: List[bytes]) -> None:
+    """Remove handled updates from a worker's processing list."""
+    processing = PROCESSING_QUEUE_KEY.format(worker_index)
+    pipeline = connection.pipeline(transaction=False)
+    for raw_update in raw_updates:
+        pipeline.lrem(processing, 1, raw_update)
+    await pipeline.execute()
+
+
+async def consume_updates(worker_index: int) -> None:
+    """Process the updates of one partition until the process gets SIGTERM."""
+    # Imported here so that each worker builds its own bot and pools.
+    from telebot.types import Update
+    from main import TOKEN, create_bot, on_startup
+
+    bot = create_bot(TOKEN)
+    await on_startup()
+    # The groups table is refreshed by the first worker only, a restarted worker
+    # continues where the refresh stopped.
+    refresher_task = None
+    if worker_index == 0:
+        import group_refresher
+        refresher_task = group_refresher.start_group_refresher({"": bot})
+    connection: Redis = await Redis.from_url(url=rd.REDIS_URL, decode_responses=False)
+    requeued = await requeue_unfinished_updates(connection, worker_index)
+    if requeued:
+        logger.warning(f"Worker {worker_index} queued {requeued} unfinished updates again.")
+    logger.info(f"Worker {worker_index} is consuming {UPDATE_QUEUE_KEY.format(worker_index)}.")
+
+    stopping = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+
+    # Like telebot's polling, every batch runs in its own task, so a slow handler
+    # (verify_private_message sleeps, /profile waits) doesn't hold up the partition.
+    running_batches = asyncio.Semaphore(WORKER_MAX_RUNNING_BATCHES)
+    batch_tasks = set()
+
+    async def process_batch(raw_updates) -> None:
+        try:
+            updates = [Update.de_json(raw_update.decode("utf-8")) for raw_update in raw_updates]
+            await bot.process_new_updates(updates)
+        except Exception as ex:
+            logger.error(ex, exc_info=True)
+        finally:
+            running_batches.release()
+        # Removed even if handling failed, an update which always fails would be retried forever.
+        try:
+            await finish_updates(connection, worker_index, raw_updates)
+        except Exception as ex:
+            logger.error(ex, exc_info=True)
+
+    while not stopping.is_set():
+        await running_batches.acquire()
+        try:
+            raw_updates = await take_updates(connection, worker_index)
+        except BaseException:
+            running_batches.release()
+            raise
+        if not raw_updates:
+            running_batches.release()
+            continue
+
+        task = asyncio.create_task(process_batch(raw_updates))
+        batch_tasks.add(task)
+        task.add_done_callback(batch_tasks.discard)
+
+    logger.info(f"Worker {worker_index} is stopping, waiting for {len(batch_tasks)} batches.")
+    if batch_tasks:
+        # Unfinished batches stay in the processing list and are handled after the restart.
+        await asyncio.wait(batch_tasks, timeout=WORKER_DRAIN_TIMEOUT)
+    if refresher_task is not None:
+        refresher_task.cancel()
+    await connection.aclose()
+
+
+def run_worker(worker_index: int) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The supervisor handles Ctrl+C.
+    # Read by main.py, which is only imported afterwards in consume_updates.
+    os.environ["ERROR_LOG_FILE"] = WORKER_ERROR_LOG_FILE.format(worker_index)
+    asyncio.run(consume_updates(worker_index))
+
+
+class Supervisor():
+    def __init__(self, token: str, workers: int):
+        # Workers are separate processes, with MemoryBackend each one would have its
+        # own groups, private messages and FSM states.
+        if storage_backends.STORAGE_BACKEND != "redis":
+            raise ValueError("supervisor.py requires STORAGE_BACKEND=redis, the workers must share one storage.")
+        self.token = token
+        self.workers = workers
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: List[multiprocessing.Process] = [None] * workers
+        self._stopping = asyncio.Event()
+
+    def _start_worker(self, worker_index: int) -> None:
+        process = self._context.Process(
+            target=run_worker,
+            args=(worker_index,),
+            name=f"bot-worker-{worker_index}",
+            daemon=True
+        )
+        process.start()
+        self._processes[worker_index] = process
+        logger.info(f"Worker {worker_index} started with pid {process.pid}.")
+
+    async def _watch_workers(self) -> None:
+        while not self._stopping.is_set():
+            for worker_index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logger.warning(
+                        f"Worker {worker_index} exited with code {process.exitcode}, restarting it."
+                    )
+                    self._start_worker(worker_index)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=WORKER_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _ingest_updates(self) -> None:
+        connection: Redis = await Redis.from_url(url=rd.REDIS_URL, decode_responses=False)
+        offset = None
+
+        while not self._stopping.is_set():
+            try:
+                raw_updates = await asyncio_helper.get_updates(
+                    self.token,
+                    offset=offset,
+                    limit=GET_UPDATES_LIMIT,
+                    timeout=GET_UPDATES_TIMEOUT,
+                    allowed_updates=ALLOWED_UPDATES
+                )
+                if not raw_updates:
+                    continue
+
+                pipeline = connection.pipeline(transaction=False)
+                for raw_update in raw_updates:
+                    worker_index = get_partition_chat_id(raw_update) % self.workers
+                    pipeline.rpush(UPDATE_QUEUE_KEY.format(worker_index), json.dumps(raw_update))
+                await pipeline.execute()
+
+                # Confirm the updates only after they are queued.
+                offset = raw_updates[-1]["update_id"] + 1
+
+            except Exception as ex:
+                logger.error(ex, exc_info=True)
+                await asyncio.sleep(3)
+
+        await connection.aclose()
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        for worker_index in range(self.workers):
+            self._start_worker(worker_index)
+
+        ingest_task = asyncio.create_task(self._ingest_updates())
+        await self._watch_workers()
+        ingest_task.cancel()
+
+        # SIGTERM lets the workers finish their running batches first.
+        for process in self._processes:
+            process.terminate()
+        deadline = time.monotonic() + WORKER_DRAIN_TIMEOUT + WORKER_POLL_TIMEOUT + WORKER_CHECK_INTERVAL
+        for worker_index, process in enumerate(self._processes):
+            process.join(timeout=max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f"Worker {worker_index} didn't stop in time, killing it.")
+                process.kill()
+                process.join()
+        logger.info("All workers stopped.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the bot with several worker processes.")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1,
+        help="Number of worker processes (default: number of CPUs)."
+    )
+    args = parser.parse_args()
+
+    TOKEN = os.environ.get("BOT_TOKEN", None)
+    if not TOKEN:
+        raise ValueError("The token doesn't exist.")
+
+    logger.setLevel("INFO")
+    asyncio.run(Supervisor(TOKEN, args.workers).run())
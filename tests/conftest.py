@@ -0,0 +1,43 @@
+import os
+import sys
+import types
+
+# The modules live in the repository root, next to main.py.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeClock():
+    """Replacement for time.monotonic() and time.time() which only moves when it's told to."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+def fake_clock(monkeypatch, *modules) -> FakeClock:
+    """Make every module in `modules` read the time from one new FakeClock and return the clock."""
+    clock = FakeClock()
+    for module in modules:
+        monkeypatch.setattr(module, "time", types.SimpleNamespace(monotonic=clock.monotonic, time=clock.time))
+    return clock
+
+
+def run(coroutine):
+    """Run a coroutine which finishes without ever suspending, like every MemoryBackend command.
+
+    No event loop is running, so MemoryBackend expiry is only lazy and the fake
+    clock can't confuse a loop timer.
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise AssertionError("The coroutine suspended.")
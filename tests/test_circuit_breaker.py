@@ -0,0 +1,167 @@
+import asyncio
+
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+from conftest import fake_clock
+
+
+class BackendError(Exception):
+    pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    return fake_clock(monkeypatch, circuit_breaker)
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker(
+        "test", (BackendError,), failure_threshold=3, reset_timeout=10,
+        call_timeout=None, slow_call_duration=0.5
+    )
+
+
+def fail():
+    raise BackendError()
+
+
+def slow(clock, seconds):
+    def call():
+        clock.advance(seconds)
+        return "slow"
+    return call
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        with pytest.raises(BackendError):
+            breaker.call_sync(fail)
+
+
+def test_opens_after_consecutive_failures(breaker):
+    for _ in range(2):
+        with pytest.raises(BackendError):
+            breaker.call_sync(fail)
+    assert breaker.state == CLOSED
+    with pytest.raises(BackendError):
+        breaker.call_sync(fail)
+    assert breaker.state == OPEN
+    assert breaker.is_open
+
+
+def test_success_resets_the_failure_count(breaker):
+    for _ in range(2):
+        with pytest.raises(BackendError):
+            breaker.call_sync(fail)
+    assert breaker.call_sync(lambda: "ok") == "ok"
+    for _ in range(2):
+        with pytest.raises(BackendError):
+            breaker.call_sync(fail)
+    assert breaker.state == CLOSED
+
+
+def test_slow_calls_count_as_failures(breaker, clock):
+    for _ in range(3):
+        assert breaker.call_sync(slow(clock, 1)) == "slow"
+    assert breaker.state == OPEN
+
+
+def test_other_errors_dont_count(breaker):
+    for _ in range(10):
+        with pytest.raises(AttributeError):
+            breaker.call_sync(lambda: None.title)
+    assert breaker.state == CLOSED
+
+
+def test_open_breaker_fails_fast(breaker):
+    open_breaker(breaker)
+    called = []
+    with pytest.raises(CircuitOpenError):
+        breaker.call_sync(lambda: called.append(True))
+    assert called == []
+
+
+def test_probe_success_closes(breaker, clock):
+    open_breaker(breaker)
+    clock.advance(10)
+    assert not breaker.is_open
+    assert breaker.call_sync(lambda: "ok") == "ok"
+    assert breaker.state == CLOSED
+
+
+def test_probe_failure_opens_again(breaker, clock):
+    open_breaker(breaker)
+    clock.advance(10)
+    with pytest.raises(BackendError):
+        breaker.call_sync(fail)
+    assert breaker.state == OPEN
+    clock.advance(5)
+    with pytest.raises(CircuitOpenError):
+        breaker.call_sync(lambda: "ok")
+
+
+def test_slow_probe_opens_again(breaker, clock):
+    open_breaker(breaker)
+    clock.advance(10)
+    breaker.call_sync(slow(clock, 1))
+    assert breaker.state == OPEN
+
+
+def test_only_one_probe_at_a_time(breaker, clock):
+    open_breaker(breaker)
+    clock.advance(10)
+
+    def probe():
+        assert breaker.state == HALF_OPEN
+        with pytest.raises(CircuitOpenError):
+            breaker.call_sync(lambda: "second")
+        return "probe"
+
+    assert breaker.call_sync(probe) == "probe"
+    assert breaker.state == CLOSED
+
+
+def test_async_timeout_counts_as_failure():
+    breaker = CircuitBreaker("test", (BackendError,), failure_threshold=1, call_timeout=0.01)
+
+    async def hang():
+        await asyncio.sleep(1)
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(breaker.call(hang))
+    assert breaker.state == OPEN
+
+
+def test_async_cancelled_probe_doesnt_close(breaker, clock):
+    open_breaker(breaker)
+    clock.advance(10)
+
+    async def cancelled_probe():
+        task = asyncio.create_task(breaker.call(asyncio.sleep, 1))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancelled_probe())
+    assert breaker.state == HALF_OPEN
+    # The next call is the probe again.
+    assert asyncio.run(breaker.call(asyncio.sleep, 0, result="ok")) == "ok"
+    assert breaker.state == CLOSED
+
+
+def test_protect_decorators(breaker):
+    @breaker.protect
+    async def async_call(value):
+        return value
+
+    @breaker.protect_sync
+    def sync_call(value):
+        return value
+
+    assert asyncio.run(async_call(1)) == 1
+    assert sync_call(2) == 2
+    assert async_call.__name__ == "async_call"
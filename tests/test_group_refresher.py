@@ -0,0 +1,153 @@
+import types
+import asyncio
+
+import pytest
+from telebot.asyncio_helper import ApiTelegramException
+
+import group_refresher
+from group_refresher import GroupMetadataRefresher, get_chat_metadata
+from redis_database import RedisDatabase as rd, key_namespace
+from storage_backends import MemoryBackend
+
+
+def make_chat(title, username=None, description=None, bio=None, photo=None):
+    return types.SimpleNamespace(title=title, username=username, description=description, bio=bio, photo=photo)
+
+
+class FakeBot():
+    def __init__(self, chats):
+        self.chats = chats
+        self.requests = []
+
+    async def get_chat(self, chat_id):
+        self.requests.append(chat_id)
+        chat = self.chats[chat_id]
+        if isinstance(chat, Exception):
+            raise chat
+        return chat
+
+
+class FakeGroupsTable():
+    """get_group_metadata_page and update_group_metadata on a dict."""
+
+    def __init__(self, rows):
+        self.rows = {row["chat_id"]: dict(row) for row in rows}
+        self.updates = []
+
+    def get_group_metadata_page(self, after_chat_id, limit):
+        chat_ids = sorted(chat_id for chat_id in self.rows if after_chat_id is None or chat_id > after_chat_id)
+        return [dict(self.rows[chat_id]) for chat_id in chat_ids[:limit]]
+
+    def update_group_metadata(self, changes):
+        self.updates.append(changes)
+        for chat_id, columns in changes.items():
+            self.rows[chat_id].update(columns)
+
+
+def make_row(chat_id, title, username=None, description=None, bio=None, json_photos=None):
+    return {
+        "chat_id": chat_id, "title": title, "username": username,
+        "description": description, "bio": bio, "json_photos": json_photos,
+    }
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = MemoryBackend()
+    monkeypatch.setattr(rd, "_pool", backend)
+    monkeypatch.setattr(group_refresher, "is_degraded", lambda: False)
+    return backend
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeGroupsTable([
+        make_row(-3, "unchanged", username="same"),
+        make_row(-2, "old title", username="public", description="description"),
+        make_row(-1, "went private", username="public_before"),
+    ])
+    monkeypatch.setattr(group_refresher.sql_database, "get_group_metadata_page", table.get_group_metadata_page)
+    monkeypatch.setattr(group_refresher.sql_database, "update_group_metadata", table.update_group_metadata)
+    return table
+
+
+def register(*chat_ids, namespace=""):
+    async def run():
+        token = key_namespace.set(namespace)
+        try:
+            for chat_id in chat_ids:
+                await rd.add_chat_id(chat_id)
+        finally:
+            key_namespace.reset(token)
+    asyncio.run(run())
+
+
+def refresh(bots, after_chat_id=None, page_size=2):
+    refresher = GroupMetadataRefresher(bots, rate=1000000, page_size=page_size)
+    return asyncio.run(refresher.refresh_all(after_chat_id))
+
+
+def test_get_chat_metadata():
+    photo = types.SimpleNamespace(small_file_id="small", big_file_id="big")
+    metadata = get_chat_metadata(make_chat("title", username="name", photo=photo))
+    assert metadata == {
+        "title": "title", "username": "name", "description": None, "bio": None,
+        "json_photos": '{"small_file_id": "small", "big_file_id": "big"}',
+    }
+    assert get_chat_metadata(make_chat("title"))["json_photos"] is None
+
+
+def test_only_changed_columns_are_written(backend, table):
+    register(-3, -2, -1)
+    bot = FakeBot({
+        -3: make_chat("unchanged", username="same"),
+        -2: make_chat("new title", username="public", description="description"),
+        -1: make_chat("went private"),
+    })
+
+    result = refresh({"": bot})
+
+    assert result == {"checked": 3, "changed": 2, "failed": 0, "skipped": 0}
+    # Pages of two groups, one transaction each.
+    assert table.updates == [{-2: {"title": "new title"}}, {-1: {"username": None}}]
+    assert asyncio.run(rd.get_group_refresh_progress())[0] is None
+
+
+def test_unreadable_and_unregistered_groups(backend, table):
+    register(-3, -2)
+    bot = FakeBot({
+        -3: make_chat("unchanged", username="same"),
+        -2: ApiTelegramException("getChat", None, {"error_code": 400, "description": "chat not found"}),
+    })
+
+    result = refresh({"": bot})
+
+    assert result == {"checked": 2, "changed": 0, "failed": 1, "skipped": 1}
+    assert -1 not in bot.requests
+    assert table.updates == [{}, {}]
+
+
+def test_each_group_is_read_by_the_first_registered_bot(backend, table):
+    register(-3, -2, namespace="first")
+    register(-2, -1, namespace="second")
+    chats = {
+        -3: make_chat("unchanged", username="same"),
+        -2: make_chat("old title", username="public", description="description"),
+        -1: make_chat("went private", username="public_before"),
+    }
+    first, second = FakeBot(chats), FakeBot(chats)
+
+    refresh({"first": first, "second": second})
+
+    assert first.requests == [-3, -2]
+    assert second.requests == [-1]
+
+
+def test_refresh_continues_after_the_cursor(backend, table):
+    register(-3, -2, -1)
+    bot = FakeBot({-1: make_chat("went private", username="public_before")})
+
+    result = refresh({"": bot}, after_chat_id=-2)
+
+    assert result["checked"] == 1
+    assert bot.requests == [-1]
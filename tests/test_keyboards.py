@@ -0,0 +1,21 @@
+import pytest
+
+from keyboards import create_linked_message_keyboard, get_message_url
+
+
+@pytest.mark.parametrize("group_chat_id, group_username, expected", [
+    (-1001234567890, "public_group", "https://t.me/public_group/42"),
+    # A supergroup without a username, e.g. after it went private.
+    (-1001234567890, None, "https://t.me/c/1234567890/42"),
+    ("-1001234567890", "", "https://t.me/c/1234567890/42"),
+    # Basic groups have no message links.
+    (-1234567, None, None),
+])
+def test_get_message_url(group_chat_id, group_username, expected):
+    assert get_message_url(group_chat_id, group_username, 42) == expected
+
+
+def test_linked_message_keyboard_is_left_out_without_a_link():
+    assert create_linked_message_keyboard(-1234567, None, 42) is None
+    keyboard = create_linked_message_keyboard(-1001234567890, None, 42)
+    assert keyboard.keyboard[0][0].url == "https://t.me/c/1234567890/42"
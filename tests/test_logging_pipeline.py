@@ -0,0 +1,69 @@
+import logging
+
+import pytest
+
+import logging_pipeline
+from logging_pipeline import DuplicateFilter
+from conftest import fake_clock
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    return fake_clock(monkeypatch, logging_pipeline)
+
+
+def make_record(message="message", exception=None, name="test"):
+    exc_info = None
+    if exception is not None:
+        try:
+            raise exception
+        except Exception as ex:
+            exc_info = (type(ex), ex, ex.__traceback__)
+    return logging.LogRecord(name, logging.ERROR, __file__, 1, message, None, exc_info)
+
+
+def test_duplicate_is_suppressed_within_the_window(clock):
+    duplicate_filter = DuplicateFilter(window=60)
+    assert duplicate_filter.filter(make_record())
+    clock.advance(59)
+    assert not duplicate_filter.filter(make_record())
+    assert not duplicate_filter.filter(make_record())
+
+
+def test_duplicate_passes_after_the_window_with_the_suppressed_count(clock):
+    duplicate_filter = DuplicateFilter(window=60)
+    duplicate_filter.filter(make_record())
+    duplicate_filter.filter(make_record())
+    duplicate_filter.filter(make_record())
+    clock.advance(60)
+    record = make_record()
+    assert duplicate_filter.filter(record)
+    assert record.suppressed == 2
+
+
+def test_different_messages_pass(clock):
+    duplicate_filter = DuplicateFilter(window=60)
+    assert duplicate_filter.filter(make_record("first"))
+    assert duplicate_filter.filter(make_record("second"))
+    assert duplicate_filter.filter(make_record("first", name="other"))
+
+
+def test_exceptions_are_keyed_by_type_message_and_location(clock):
+    duplicate_filter = DuplicateFilter(window=60)
+    assert duplicate_filter.filter(make_record("a", ValueError("boom")))
+    # Same exception from the same place, the log message doesn't matter.
+    assert not duplicate_filter.filter(make_record("b", ValueError("boom")))
+    assert duplicate_filter.filter(make_record("a", ValueError("other")))
+    assert duplicate_filter.filter(make_record("a", KeyError("boom")))
+
+
+def test_least_recently_seen_key_is_forgotten(clock):
+    duplicate_filter = DuplicateFilter(window=60, max_keys=2)
+    duplicate_filter.filter(make_record("1"))
+    duplicate_filter.filter(make_record("2"))
+    # Seeing "1" again makes "2" the least recently seen record.
+    assert not duplicate_filter.filter(make_record("1"))
+    assert duplicate_filter.filter(make_record("3"))
+    assert len(duplicate_filter._seen) == 2
+    assert not duplicate_filter.filter(make_record("1"))
+    assert duplicate_filter.filter(make_record("2"))
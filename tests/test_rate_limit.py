@@ -0,0 +1,59 @@
+import types
+import asyncio
+
+import pytest
+
+import rate_limit
+from rate_limit import TokenBucket
+from conftest import fake_clock
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A clock which asyncio.sleep in TokenBucket moves forward instead of waiting."""
+    clock = fake_clock(monkeypatch, rate_limit)
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+        clock.advance(seconds)
+
+    monkeypatch.setattr(rate_limit, "asyncio", types.SimpleNamespace(sleep=sleep, Lock=asyncio.Lock))
+    clock.sleeps = sleeps
+    return clock
+
+
+def acquire(bucket, times):
+    async def run():
+        for _ in range(times):
+            await bucket.acquire()
+    asyncio.run(run())
+
+
+def test_burst_up_to_capacity_doesnt_wait(clock):
+    bucket = TokenBucket(rate=10, capacity=5)
+    acquire(bucket, 5)
+    assert clock.sleeps == []
+
+
+def test_waits_for_the_next_token_beyond_capacity(clock):
+    bucket = TokenBucket(rate=10, capacity=5)
+    acquire(bucket, 6)
+    assert clock.sleeps == [pytest.approx(0.1)]
+
+
+def test_average_rate(clock):
+    bucket = TokenBucket(rate=10, capacity=1)
+    started = clock.now
+    acquire(bucket, 101)
+    assert clock.now - started == pytest.approx(10)
+
+
+def test_tokens_refill_up_to_capacity(clock):
+    bucket = TokenBucket(rate=10, capacity=2)
+    acquire(bucket, 2)
+    clock.advance(60)
+    acquire(bucket, 2)
+    assert clock.sleeps == []
+    acquire(bucket, 1)
+    assert clock.sleeps == [pytest.approx(0.1)]
@@ -0,0 +1,182 @@
+import random
+
+import pytest
+
+import redis_database
+import storage_backends
+from redis_database import RedisDatabase as rd
+from storage_backends import MemoryBackend
+from conftest import fake_clock, run
+
+USER_ID = "7"
+GROUP_CHAT_ID = "-1001"
+# One, two, three and four byte UTF-8 characters.
+CHARACTERS = "ab éא€中\U0001f600"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    return fake_clock(monkeypatch, storage_backends, redis_database)
+
+
+@pytest.fixture
+def backend(monkeypatch, clock):
+    backend = MemoryBackend()
+    monkeypatch.setattr(rd, "_pool", backend)
+    return backend
+
+
+def count_getrange_calls(monkeypatch, backend):
+    calls = []
+    getrange = backend.getrange
+
+    async def counted_getrange(*args):
+        calls.append(args)
+        return await getrange(*args)
+
+    monkeypatch.setattr(backend, "getrange", counted_getrange)
+    return calls
+
+
+def store(text, message_id="1"):
+    run(rd.store_private_message(USER_ID, GROUP_CHAT_ID, message_id, text))
+
+
+def test_short_message_is_stored_uncompressed(backend):
+    store("hello")
+    assert run(backend.get(rd._private_message_key(USER_ID, GROUP_CHAT_ID, "1"))) == b"hello"
+
+
+def test_long_message_is_stored_compressed(backend):
+    text = "private message " * 100
+    store(text)
+    blob = run(backend.get(rd._private_message_key(USER_ID, GROUP_CHAT_ID, "1")))
+    assert blob.startswith(rd.COMPRESSED_MARKER)
+    assert len(blob) < len(text)
+    assert run(rd.get_private_message(USER_ID, GROUP_CHAT_ID, "1")) == text
+
+
+def test_missing_message(backend):
+    assert run(rd.get_private_message(USER_ID, GROUP_CHAT_ID, "1")) is None
+    assert run(rd.get_private_message_preview(USER_ID, GROUP_CHAT_ID, "1", limit=10)) is None
+
+
+@pytest.mark.parametrize("chunk_size", [len(rd.COMPRESSED_MARKER), 3, 7, 4096])
+def test_round_trip_across_chunk_and_character_boundaries(backend, monkeypatch, chunk_size):
+    monkeypatch.setattr(rd, "CHUNK_SIZE", chunk_size)
+    generator = random.Random(chunk_size)
+    for message_id in range(50):
+        # Random text compresses badly, repeated text well, so both encodings are covered.
+        text = "".join(generator.choice(CHARACTERS) for _ in range(generator.randrange(1, 400)))
+        if message_id % 2:
+            text *= 5
+        store(text, str(message_id))
+        assert run(rd.get_private_message(USER_ID, GROUP_CHAT_ID, str(message_id))) == text
+
+        limit = generator.randrange(2, 300)
+        preview = run(rd.get_private_message_preview(USER_ID, GROUP_CHAT_ID, str(message_id), limit))
+        if len(text) <= limit:
+            assert preview == (text, False)
+        else:
+            assert preview == (text[:limit - 1] + "…", True)
+
+
+def test_message_shorter_than_a_chunk_is_read_with_one_getrange(backend, monkeypatch):
+    calls = count_getrange_calls(monkeypatch, backend)
+    store("hello")
+    assert run(rd.get_private_message(USER_ID, GROUP_CHAT_ID, "1")) == "hello"
+    assert len(calls) == 1
+
+
+def test_preview_stops_reading_once_it_has_enough_text(backend, monkeypatch):
+    monkeypatch.setattr(rd, "CHUNK_SIZE", 16)
+    calls = count_getrange_calls(monkeypatch, backend)
+    generator = random.Random(0)
+    store("".join(generator.choice("abcdefgh") for _ in range(1000)))
+    preview, truncated = run(rd.get_private_message_preview(USER_ID, GROUP_CHAT_ID, "1", limit=20))
+    assert truncated and len(preview) == 20
+    assert len(calls) < 10
+
+
+def test_inbox_pages_newest_first(backend, clock):
+    for message_id in range(5):
+        store(f"message {message_id}", str(message_id))
+        clock.advance(1)
+
+    total, entries = run(rd.get_inbox(USER_ID, page=0, page_size=2))
+    assert total == 5
+    assert [entry.private_message_id for entry in entries] == ["4", "3"]
+    assert entries[0] == redis_database.InboxEntry(GROUP_CHAT_ID, "4", "message 4")
+
+    total, entries = run(rd.get_inbox(USER_ID, page=2, page_size=2))
+    assert total == 5
+    assert [entry.private_message_id for entry in entries] == ["0"]
+    assert run(rd.get_inbox(USER_ID, page=3, page_size=2)) == (5, [])
+
+
+def test_inbox_prunes_expired_messages(backend, clock):
+    store("old", "1")
+    clock.advance(rd.PRIVATE_MESSAGE_TTL / 2)
+    store("new", "2")
+    clock.advance(rd.PRIVATE_MESSAGE_TTL / 2)
+
+    total, entries = run(rd.get_inbox(USER_ID, page=0, page_size=10))
+    assert total == 1
+    assert [entry.private_message_text for entry in entries] == ["new"]
+    assert run(backend.zcard(rd.INBOX_KEY.format(USER_ID))) == 1
+
+
+def test_inbox_skips_entries_whose_message_is_gone(backend):
+    store("kept", "1")
+    store("deleted", "2")
+    run(backend.delete(rd._private_message_key(USER_ID, GROUP_CHAT_ID, "2")))
+
+    total, entries = run(rd.get_inbox(USER_ID, page=0, page_size=10))
+    assert total == 2
+    assert [entry.private_message_text for entry in entries] == ["kept"]
+
+
+def test_inbox_of_another_user_is_empty(backend):
+    store("hello")
+    assert run(rd.get_inbox("8", page=0, page_size=10)) == (0, [])
+
+
+def test_user_groups_keep_the_most_recently_seen(backend, clock, monkeypatch):
+    monkeypatch.setattr(rd, "USER_GROUPS_LIMIT", 3)
+    for chat_id in ("-1", "-2", "-3", "-4"):
+        run(rd.add_chat_id(chat_id))
+        run(rd.add_user_group(USER_ID, chat_id))
+        clock.advance(1)
+    # Seeing the user in -2 again makes it the most recent group.
+    run(rd.add_user_group(USER_ID, "-2"))
+
+    assert run(rd.get_user_groups(USER_ID)) == ["-2", "-4", "-3"]
+    assert run(rd.has_user_group(USER_ID, "-2"))
+    assert not run(rd.has_user_group(USER_ID, "-1"))
+    assert not run(rd.has_user_group("8", "-2"))
+
+
+def test_user_groups_only_lists_registered_groups(backend):
+    run(rd.add_chat_id(-1))
+    run(rd.add_user_group(USER_ID, -1))
+    run(rd.add_user_group(USER_ID, -2))
+
+    assert run(rd.get_user_groups(USER_ID)) == ["-1"]
+    # The index itself still has the group, has_user_group doesn't check the registration.
+    assert run(rd.has_user_group(USER_ID, -2))
+
+
+def test_removed_user_group(backend):
+    run(rd.add_user_group(USER_ID, -1))
+    run(rd.remove_user_group(USER_ID, -1))
+    assert not run(rd.has_user_group(USER_ID, -1))
+
+
+def test_user_groups_expire_after_inactivity(backend, clock):
+    run(rd.add_user_group(USER_ID, -1))
+    clock.advance(rd.USER_GROUPS_TTL - 1)
+    run(rd.add_user_group(USER_ID, -2))
+    clock.advance(rd.USER_GROUPS_TTL - 1)
+    assert run(rd.has_user_group(USER_ID, -1))
+    clock.advance(1)
+    assert not run(rd.has_user_group(USER_ID, -1))
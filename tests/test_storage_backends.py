@@ -0,0 +1,164 @@
+import pytest
+
+import storage_backends
+from storage_backends import MemoryBackend, _normalize_range
+from conftest import fake_clock, run
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    return fake_clock(monkeypatch, storage_backends)
+
+
+@pytest.fixture
+def backend(clock):
+    return MemoryBackend()
+
+
+@pytest.mark.parametrize("start, end, length, expected", [
+    (0, -1, 5, (0, 4)),
+    (1, 2, 5, (1, 2)),
+    (-2, -1, 5, (3, 4)),
+    (-10, 2, 5, (0, 2)),
+    (3, 1, 5, (0, -1)),
+    (0, -1, 0, (0, -1)),
+    (0, -6, 5, (0, -1)),
+])
+def test_normalize_range(start, end, length, expected):
+    assert _normalize_range(start, end, length) == expected
+
+
+def test_key_expires_after_its_ttl(backend, clock):
+    run(backend.set("key", b"value", ex=10))
+    clock.advance(9.9)
+    assert run(backend.get("key")) == b"value"
+    clock.advance(0.1)
+    assert run(backend.get("key")) is None
+    assert backend._heap == []
+
+
+def test_set_without_ttl_persists_the_key(backend, clock):
+    run(backend.set("key", b"value", ex=10))
+    run(backend.set("key", b"other"))
+    clock.advance(20)
+    assert run(backend.get("key")) == b"other"
+
+
+def test_expire_moves_the_deadline_later(backend, clock):
+    run(backend.set("key", b"value", ex=10))
+    clock.advance(8)
+    run(backend.expire("key", 10))
+    clock.advance(8)
+    assert run(backend.get("key")) == b"value"
+    clock.advance(2)
+    assert run(backend.get("key")) is None
+
+
+def test_expire_moves_the_deadline_earlier(backend, clock):
+    run(backend.set("key", b"value", ex=100))
+    run(backend.expire("key", 1))
+    clock.advance(1)
+    assert run(backend.get("key")) is None
+
+
+def test_refreshing_a_ttl_keeps_one_heap_entry(backend, clock):
+    run(backend.zadd("sorted", {"member": 1}))
+    for _ in range(1000):
+        run(backend.expire("sorted", 30))
+        clock.advance(0.01)
+    assert len(backend._heap) == 1
+
+
+def test_expire_of_a_missing_key_does_nothing(backend):
+    run(backend.expire("missing", 10))
+    assert backend._heap == []
+
+
+def test_deleted_key_doesnt_expire_its_successor(backend, clock):
+    run(backend.set("key", b"value", ex=10))
+    run(backend.delete("key"))
+    run(backend.set("key", b"new"))
+    clock.advance(20)
+    assert run(backend.get("key")) == b"new"
+
+
+def test_getrange_is_inclusive_and_accepts_negative_indices(backend):
+    run(backend.set("key", b"0123456789"))
+    assert run(backend.getrange("key", 0, 3)) == b"0123"
+    assert run(backend.getrange("key", 8, 100)) == b"89"
+    assert run(backend.getrange("key", -3, -1)) == b"789"
+    assert run(backend.getrange("key", 20, 30)) == b""
+    assert run(backend.getrange("missing", 0, -1)) == b""
+
+
+def test_sets(backend):
+    run(backend.sadd("set", 1))
+    run(backend.sadd("set", "2"))
+    assert run(backend.sismember("set", "1"))
+    assert not run(backend.sismember("set", 3))
+    assert run(backend.smismember("set", [1, 3, "2"])) == [True, False, True]
+    assert run(backend.smismember("missing", [1])) == [False]
+
+
+def test_mget(backend):
+    run(backend.set("a", b"1"))
+    assert run(backend.mget(["a", "b"])) == [b"1", None]
+
+
+def test_zrevrange_orders_by_score_then_member(backend):
+    run(backend.zadd("sorted", {"a": 1, "b": 3, "c": 2, "d": 3}))
+    assert run(backend.zrevrange("sorted", 0, -1)) == [b"d", b"b", b"c", b"a"]
+    assert run(backend.zrevrange("sorted", 1, 2)) == [b"b", b"c"]
+    assert run(backend.zrevrange("sorted", -1, -1)) == [b"a"]
+    assert run(backend.zcard("sorted")) == 4
+    assert run(backend.zscore("sorted", "c")) == 2.0
+    assert run(backend.zscore("sorted", "missing")) is None
+
+
+def test_zadd_updates_the_score(backend):
+    run(backend.zadd("sorted", {"a": 1, "b": 2}))
+    run(backend.zadd("sorted", {"a": 3}))
+    assert run(backend.zrevrange("sorted", 0, 0)) == [b"a"]
+    assert run(backend.zcard("sorted")) == 2
+
+
+def test_zremrangebyrank_keeps_the_highest_scores(backend):
+    run(backend.zadd("sorted", {str(score): score for score in range(10)}))
+    # The way RedisDatabase.add_user_group keeps the 3 most recent groups.
+    run(backend.zremrangebyrank("sorted", 0, -3 - 1))
+    assert run(backend.zrevrange("sorted", 0, -1)) == [b"9", b"8", b"7"]
+
+
+def test_zremrangebyrank_with_an_empty_range_removes_nothing(backend):
+    run(backend.zadd("sorted", {"a": 1, "b": 2}))
+    run(backend.zremrangebyrank("sorted", 0, -10))
+    assert run(backend.zcard("sorted")) == 2
+
+
+def test_zremrangebyscore_is_inclusive(backend):
+    run(backend.zadd("sorted", {"a": 1, "b": 2, "c": 3}))
+    run(backend.zremrangebyscore("sorted", float("-inf"), 2))
+    assert run(backend.zrevrange("sorted", 0, -1)) == [b"c"]
+
+
+def test_empty_sorted_set_doesnt_exist(backend, clock):
+    run(backend.zadd("sorted", {"a": 1}))
+    run(backend.expire("sorted", 10))
+    run(backend.zrem("sorted", "a"))
+    assert "sorted" not in backend._data
+    run(backend.zadd("sorted", {"b": 1}))
+    clock.advance(20)
+    # The TTL of the deleted set doesn't apply to the new one.
+    assert run(backend.zcard("sorted")) == 1
+
+
+def test_pipeline_returns_the_results_in_order(backend):
+    pipeline = backend.pipeline(transaction=True)
+    pipeline.zadd("sorted", {"a": 1, "b": 2})
+    pipeline.zcard("sorted")
+    pipeline.zrevrange("sorted", 0, 0)
+    pipeline.set("key", b"value", ex=10)
+    pipeline.delete("key")
+    results = run(pipeline.execute())
+    assert results[1:3] == [2, [b"b"]]
+    assert run(backend.get("key")) is None
@@ -0,0 +1,27 @@
+import pytest
+
+from supervisor import get_partition_chat_id
+
+USER = {"id": 7, "is_bot": False, "first_name": "user"}
+GROUP = {"id": -1001, "type": "supergroup", "title": "group"}
+
+
+@pytest.mark.parametrize("update, chat_id", [
+    ({"update_id": 1, "message": {"message_id": 1, "from": USER, "chat": GROUP}}, -1001),
+    ({"update_id": 1, "my_chat_member": {"from": USER, "chat": GROUP}}, -1001),
+    ({"update_id": 1, "chat_member": {"from": USER, "chat": GROUP}}, -1001),
+    # Callback queries belong to the chat of their message.
+    ({"update_id": 1, "callback_query": {"id": "1", "from": USER, "message": {"chat": GROUP}}}, -1001),
+    # Without a chat the sender is used, and the update id without a sender.
+    ({"update_id": 1, "callback_query": {"id": "1", "from": USER, "inline_message_id": "x"}}, 7),
+    ({"update_id": 1, "inline_query": {"id": "1", "from": USER, "query": ""}}, 7),
+    ({"update_id": 5, "poll": {"id": "1", "question": "?"}}, 5),
+])
+def test_get_partition_chat_id(update, chat_id):
+    assert get_partition_chat_id(update) == chat_id
+
+
+def test_updates_of_a_chat_go_to_one_worker():
+    message = {"update_id": 1, "message": {"message_id": 1, "from": USER, "chat": GROUP}}
+    callback = {"update_id": 2, "callback_query": {"id": "1", "from": USER, "message": {"chat": GROUP}}}
+    assert get_partition_chat_id(message) % 4 == get_partition_chat_id(callback) % 4